@@ -5,6 +5,7 @@ __all__ = [
     "DatabaseHealthCheck",
     "find_differences_in_inputs",
     "GTManipulator",
+    "iterate_supply_chain",
     "PageRank",
     "print_recursive_calculation",
     "print_recursive_supply_chain",
@@ -24,5 +25,9 @@ from .page_rank import PageRank
 # from .report import SerializedLCAReport
 from .sc_graph import GTManipulator
 from .tagged import traverse_tagged_databases
-from .utils import print_recursive_calculation, print_recursive_supply_chain
+from .utils import (
+    iterate_supply_chain,
+    print_recursive_calculation,
+    print_recursive_supply_chain,
+)
 from .version import version as __version__
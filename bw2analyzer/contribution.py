@@ -1,5 +1,15 @@
 import numpy as np
+import pandas as pd
+from bw2calc import LCA
 from bw2data import get_activity
+from bw2data.backends import Activity
+from scipy import sparse
+
+from .utils import (
+    _factorized_technosphere,
+    _stacked_characterization,
+    resolve_activities,
+)
 
 
 class ContributionAnalysis:
@@ -25,6 +35,8 @@ class ContributionAnalysis:
                 (1, 0)
             )
 
+        Only the selected values are sorted: in ``number`` mode they are found with ``np.argpartition``, and in ``percent`` mode with the threshold. Values with the same absolute value are returned with the highest row index first.
+
         Args:
             * *data* (numpy array): A 1-d array of values to sort.
             * *limit* (number, default=25): Number of values to return, or percentage cutoff.
@@ -35,18 +47,28 @@ class ContributionAnalysis:
             2-d numpy array of values and row indices.
 
         """
-        total = total or np.abs(data).sum()
+        data = np.asarray(data).ravel()
+        scores = np.abs(data)
+        total = total or scores.sum()
         if limit_type not in ("number", "percent"):
             raise ValueError("limit_type must be either 'percent' or 'index'.")
         if limit_type == "percent":
             if not 0 < limit <= 1:
                 raise ValueError("Percentage limits > 0 and <= 1.")
-            limit = (np.abs(data) >= (total * limit)).sum()
-
-        results = np.hstack(
-            (data.reshape((-1, 1)), np.arange(data.shape[0]).reshape((-1, 1)))
-        )
-        return results[np.argsort(np.abs(data))[::-1]][:limit, :]
+            selected = np.flatnonzero(scores >= (total * limit))
+        elif 0 < limit < data.shape[0]:
+            # Everything at least as large as the ``limit``-th largest value;
+            # ties at the boundary are resolved by the sort below
+            kth = scores[np.argpartition(scores, data.shape[0] - limit)[-limit]]
+            selected = np.flatnonzero(scores >= kth)
+        else:
+            selected = np.arange(data.shape[0])
+
+        # Reversed stable sort: descending values, and ties by descending index
+        order = selected[np.argsort(scores[selected], kind="stable")[::-1]]
+        if limit_type == "number":
+            order = order[:limit]
+        return np.column_stack((data[order], order))
 
     def top_matrix(self, matrix, rows=5, cols=5):
         """
@@ -79,8 +101,10 @@ class ContributionAnalysis:
                 (1, 2)
             )
 
+        The top rows and columns are taken from the matrix with one fancy-index operation; sparse matrices are never converted to dense.
+
         Args:
-            * *matrix* (array or matrix): Any Python object that supports the ``.sum(axis=)`` syntax.
+            * *matrix* (array or matrix): Any Python object that supports the ``.sum(axis=)`` syntax, e.g. a NumPy array or SciPy sparse matrix.
             * *rows* (int): Number of rows to select.
             * *cols* (int): Number of columns to select.
 
@@ -93,18 +117,35 @@ class ContributionAnalysis:
         top_cols = np.argsort(np.abs(np.array(matrix.sum(axis=0)).ravel()))[
             : -cols - 1 : -1
         ]
-        elements = []
-        for row, x in enumerate(top_rows):
-            for col, y in enumerate(top_cols):
-                if matrix[x, y] != 0:
-                    elements.append((x, y, row, col, float(matrix[x, y])))
+        if sparse.issparse(matrix):
+            submatrix = matrix.tocsr()[top_rows, :][:, top_cols].tocoo()
+            submatrix.sum_duplicates()
+            row, col, values = submatrix.row, submatrix.col, submatrix.data
+            mask = values != 0
+            row, col, values = row[mask], col[mask], values[mask]
+            # Same order as looping over top rows, then top columns
+            order = np.lexsort((col, row))
+            row, col, values = row[order], col[order], values[order]
+        else:
+            submatrix = np.asarray(matrix)[np.ix_(top_rows, top_cols)]
+            row, col = np.nonzero(submatrix)
+            values = submatrix[row, col]
+        elements = list(
+            zip(
+                top_rows[row].tolist(),
+                top_cols[col].tolist(),
+                row.tolist(),
+                col.tolist(),
+                values.astype(float).tolist(),
+            )
+        )
         return elements, top_rows.astype(int), top_cols.astype(int)
 
     def hinton_matrix(self, lca, rows=5, cols=5):
         coo, b, t = self.top_matrix(lca.characterized_inventory, rows=rows, cols=cols)
         coo = [row[2:] for row in coo]  # Don't need matrix indices
-        flows = [self.get_name(lca.dicts.biosphere.reversed[x]) for x in b]
-        activities = [self.get_name(lca.dicts.activity.reversed[x]) for x in t]
+        flows = self.get_names([lca.dicts.biosphere.reversed[x] for x in b])
+        activities = self.get_names([lca.dicts.activity.reversed[x] for x in t])
         return {
             "results": coo,
             "total": lca.score,
@@ -141,7 +182,10 @@ class ContributionAnalysis:
             )
         ]
         if names:
-            results = [(x[0], x[1], get_activity(x[2])) for x in results]
+            activities = self.get_activities([x[2] for x in results])
+            results = [
+                (x[0], x[1], activity) for x, activity in zip(results, activities)
+            ]
         return results
 
     def annotated_top_emissions(self, lca, names=True, **kwargs):
@@ -151,18 +195,135 @@ class ContributionAnalysis:
 
         """
         results = [
-            (score, lca.inventory[index, :].sum(), lca.dicts.biosphere.reversed[index])
+            (
+                score,
+                lca.inventory[int(index), :].sum(),
+                lca.dicts.biosphere.reversed[int(index)],
+            )
             for score, index in self.top_emissions(
                 lca.characterized_inventory, **kwargs
             )
         ]
         if names:
-            results = [(x[0], x[1], get_activity(x[2])) for x in results]
+            activities = self.get_activities([x[2] for x in results])
+            results = [
+                (x[0], x[1], activity) for x, activity in zip(results, activities)
+            ]
         return results
 
+    def annotated_top_batch(self, demands, methods, names=True, **kwargs):
+        """Get the most damaging processes and biosphere flows for every combination of ``demands`` and ``methods``.
+
+        Gives the same results as ``annotated_top_processes`` and ``annotated_top_emissions``, but builds and factorizes one technosphere matrix for all demands, solves all demands in one multi-RHS call, and characterizes each inventory with all methods at once. Activity metadata is resolved with one query for the whole batch.
+
+        Args:
+            * *demands* (list): List of demand dictionaries, with activities, activity keys or activity ids as keys and amounts as values.
+            * *methods* (list): List of method tuples.
+            * *names* (bool, default=True): Add the ``name``, ``location``, ``unit``, ``database`` and ``code`` of each activity or flow.
+
+        Additional keyword arguments, like ``limit`` and ``limit_type``, are passed to ``sort_array``.
+
+        Returns:
+            ``pandas.DataFrame`` in long format, with one row per selected process or flow, and the columns ``demand`` (index in ``demands``), ``method``, ``kind`` (``process`` or ``emission``), ``rank``, ``score``, ``amount`` (supply for processes, inventory amount for flows), and ``id``.
+
+        """
+        methods = [tuple(method) for method in methods]
+        keys = {
+            key for demand in demands for key in demand if not isinstance(key, Activity)
+        }
+        activities = dict(zip(keys, self.get_activities(keys)))
+        demands = [
+            [
+                (key if isinstance(key, Activity) else activities[key], amount)
+                for key, amount in demand.items()
+            ]
+            for demand in demands
+        ]
+        combined = {activity: 1 for demand in demands for activity, _ in demand}
+        lca = LCA(combined, methods[0])
+        # The technosphere matrix is only factorized once, by ``splu``
+        lca.load_lci_data()
+        lca.load_lcia_data()
+        solver = _factorized_technosphere(lca)
+        characterization = _stacked_characterization(lca, methods)
+        biosphere = lca.biosphere_matrix.tocsr()
+        activity_cfs = (characterization * biosphere).toarray()
+        characterization = characterization.toarray()
+
+        demand_array = np.zeros((len(lca.dicts.product), len(demands)))
+        for column, demand in enumerate(demands):
+            for activity, amount in demand:
+                demand_array[lca.dicts.product[activity.id], column] += amount
+        supply = solver.solve(demand_array)
+        inventory = biosphere * supply
+
+        rows = []
+        for column in range(len(demands)):
+            # All methods at once: ``(methods, activities)`` and ``(methods, flows)``
+            blocks = (
+                (
+                    "process",
+                    activity_cfs * supply[:, column],
+                    supply,
+                    lca.dicts.activity,
+                ),
+                (
+                    "emission",
+                    characterization * inventory[:, column],
+                    inventory,
+                    lca.dicts.biosphere,
+                ),
+            )
+            for kind, scores, amounts, mapping in blocks:
+                for method, method_scores in zip(methods, scores):
+                    for rank, (score, index) in enumerate(
+                        self.sort_array(method_scores, **kwargs)
+                    ):
+                        rows.append(
+                            (
+                                column,
+                                method,
+                                kind,
+                                rank,
+                                score,
+                                amounts[int(index), column],
+                                mapping.reversed[int(index)],
+                            )
+                        )
+
+        df = pd.DataFrame(
+            rows,
+            columns=["demand", "method", "kind", "rank", "score", "amount", "id"],
+        )
+        if names:
+            activities = resolve_activities(df["id"].unique())
+            for field in ("name", "location", "unit", "database", "code"):
+                df[field] = [activities[id_].get(field) for id_ in df["id"]]
+        return df
+
     def get_name(self, key):
         return get_activity(key).get("name", "Unknown")
 
+    def get_activities(self, keys):
+        """Get the activities for a list of activity ids or keys.
+
+        Activity ids are resolved together with ``resolve_activities``, i.e. with at most one query, and cached for the whole process."""
+        keys = list(keys)
+        ids = [key for key in keys if isinstance(key, (int, np.integer))]
+        activities = resolve_activities(ids)
+        return [
+            activities[int(key)]
+            if isinstance(key, (int, np.integer))
+            else get_activity(key)
+            for key in keys
+        ]
+
+    def get_names(self, keys):
+        """Like ``get_name``, but for a list of activity ids or keys; see ``get_activities``."""
+        return [
+            activity.get("name", "Unknown") for activity in self.get_activities(keys)
+        ]
+
     def d3_treemap(
         self, matrix, rev_bio, rev_techno, limit=0.025, limit_type="percent"
     ):
@@ -183,33 +344,44 @@ class ContributionAnalysis:
             }
 
         """
-        total = np.abs(matrix).sum()
+        # Work on the nonzero ``data``/``indices`` slice of each column
+        matrix = sparse.csc_matrix(matrix)
+        total = np.abs(matrix.data).sum()
         processes = self.top_processes(matrix, limit=limit, limit_type=limit_type)
-        data = {"name": "LCA result", "children": [], "size": total}
+        columns = []
         for _, tech_index in processes:
-            name = self.get_name(rev_techno[tech_index])
-            this_score = np.abs(matrix[:, int(tech_index)].toarray().ravel()).sum()
-            children = []
-            for score, bio_index in self.sort_array(
-                matrix[:, int(tech_index)].toarray().ravel(),
-                limit=limit,
-                limit_type=limit_type,
-                total=total,
-            ):
-                children.append(
-                    {
-                        "name": self.get_name(rev_bio[bio_index]),
-                        "size": float(abs(matrix[int(bio_index), int(tech_index)])),
-                    }
-                )
-            children_score = sum([x["size"] for x in children])
+            start, end = matrix.indptr[int(tech_index) : int(tech_index) + 2]
+            values = matrix.data[start:end]
+            rows = matrix.indices[start:end]
+            selected = self.sort_array(
+                values, limit=limit, limit_type=limit_type, total=total
+            )
+            order = selected[:, 1].astype(int)
+            columns.append((np.abs(values).sum(), rows[order], np.abs(values[order])))
+        # Resolve all names at once
+        keys = [rev_techno[tech_index] for _, tech_index in processes] + [
+            rev_bio[bio_index]
+            for _, bio_indices, _ in columns
+            for bio_index in bio_indices
+        ]
+        names = dict(zip(keys, self.get_names(keys)))
+
+        data = {"name": "LCA result", "children": [], "size": total}
+        for (_, tech_index), (this_score, bio_indices, sizes) in zip(
+            processes, columns
+        ):
+            children = [
+                {"name": names[rev_bio[bio_index]], "size": float(size)}
+                for bio_index, size in zip(bio_indices, sizes)
+            ]
+            children_score = sizes.sum()
             if children_score < (0.95 * this_score):
                 children.append({"name": "Others", "size": this_score - children_score})
             data["children"].append(
                 {
-                    "name": name,
+                    "name": names[rev_techno[tech_index]],
                     "size": this_score,
-                    # "children": children
+                    "children": children,
                 }
             )
         return data
@@ -1,12 +1,22 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
 from warnings import warn
 
+import numpy as np
+import pandas as pd
 from bw2calc import LCA
-from bw2data import Method, get_activity, Database
+from bw2data import Method, get_activity, Database, projects
+from bw2data.backends import Activity, ActivityDataset, ExchangeDataset
+from scipy import sparse
+
+from .utils import _activities_by_id, _stacked_characterization, _unit_scores
 
 
 def traverse_tagged_databases(
-    functional_unit, method, label="tag", default_tag="other", secondary_tags=[], fg_databases=None
+    functional_unit, method, label="tag", default_tag="other", secondary_tags=[], fg_databases=None,
+    cache_size=0, prefetch=True, compact=False, stream=False, totals=None,
 ):
 
     """Traverse a functional unit throughout its foreground database(s) or the 
@@ -59,22 +69,64 @@ def traverse_tagged_databases(
         * ``secondary_tags``: List of tuples in the format (secondary_label, secondary_default_tag). Default is empty list.
         * ``fg_databases``: a list of foreground databases to be traversed, e.g. ['foreground', 'biomass', 'machinery']
                             It's not recommended to include all databases of a project in the list to be traversed, especially not ecoinvent itself
+        * ``cache_size``: Number of foreground activities whose tagged results are kept in a ``TaggedResultCache`` and reused when the activity is visited again, e.g. in diamond-shaped foreground models. Default is ``0`` (no caching).
+        * ``prefetch``: Load all activities and exchanges of the foreground databases into a ``ForegroundIndex`` with a few bulk queries before traversing. Default is ``True``.
+        * ``compact``: Return the tagged supply chain graph as ``TaggedGraphArrays`` instead of nested dictionaries. The arrays are filled during the traversal, so the nested graph is never built; ``cache_size`` is not used. Default is ``False``.
+        * ``stream``: Don't build the graph, but return a generator of flat records from ``iterate_tagged_databases``. Always uses a ``ForegroundIndex`` and no cache, and can't be combined with ``compact``. Default is ``False``.
+        * ``totals``: Optional dictionary, which is updated with the running sum of impacts by primary tag as the records of ``stream`` are yielded.
 
     Returns:
 
         Aggregated tags dictionary from ``aggregate_tagged_graph``, and tagged supply chain graph from ``recurse_tagged_database``.
 
     """
+    if stream:
+        if compact:
+            raise ValueError("`stream` can't be combined with `compact`")
+        return iterate_tagged_databases(
+            functional_unit, method, label, default_tag, secondary_tags, fg_databases,
+            totals=totals,
+        )
 
+    # Only the matrices are needed; ``_unit_scores`` factorizes the technosphere
     lca = LCA(functional_unit, method)
-    lca.lci()
-    lca.lcia()
+    lca.load_lci_data()
+    lca.load_lcia_data()
 
     method_dict = {o[0]: o[1] for o in Method(method).load()}
+    # Scores of one unit of each activity; the inputs from outside the
+    # foreground are then assessed by lookup instead of a new solve each
+    unit_scores = _unit_scores(lca)
+
+    if prefetch:
+        index = ForegroundIndex(_index_databases(functional_unit, fg_databases))
+    else:
+        index = None
+
+    if compact:
+        # Fill the arrays node by node instead of building the nested graph
+        roots = []
+        for key, amount in functional_unit.items():
+            activity = key
+            if isinstance(key, tuple):
+                activity = get_activity(key) if index is None else index.get_activity(key)
+            context = _TraversalContext(
+                method_dict, lca, label, default_tag, secondary_tags,
+                fg_databases or [activity["database"]],
+                check_size=fg_databases is not None,
+                unit_scores=unit_scores, index=index,
+            )
+            roots.append((activity, amount, partial(_assess_tagged, context=context)))
+        graph = _compact_tagged_traversal(roots)
+        return aggregate_tagged_graph(graph), graph
+
+    # One cache for all starting nodes, which can share sub-graphs
+    cache = TaggedResultCache(cache_size) if cache_size else None
 
     graph = [
         recurse_tagged_database(
-            key, amount, method_dict, lca, label, default_tag, secondary_tags, fg_databases
+            key, amount, method_dict, lca, label, default_tag, secondary_tags, fg_databases,
+            unit_scores=unit_scores, cache=cache, index=index,
         )
         for key, amount in functional_unit.items()
     ]
@@ -82,6 +134,113 @@ def traverse_tagged_databases(
     return aggregate_tagged_graph(graph), graph
 
 
+_worker_state = {}
+
+
+def _index_databases(functional_unit, fg_databases):
+    """Databases to put in the ``ForegroundIndex``: ``fg_databases`` and the databases of the functional unit activities."""
+    return set(fg_databases or []) | {
+        key[0] if isinstance(key, tuple) else key["database"] for key in functional_unit
+    }
+
+
+def _tagged_traversal_state(demand, method, fg_databases):
+    """Calculate everything a tagged traversal needs which doesn't depend on the functional unit: the ``LCA`` of ``demand``, the characterization factors, the unit scores of all products, and the ``ForegroundIndex``."""
+    lca = LCA(demand, method)
+    lca.load_lci_data()
+    lca.load_lcia_data()
+    return {
+        "lca": lca,
+        "method_dict": {o[0]: o[1] for o in Method(method).load()},
+        "unit_scores": _unit_scores(lca),
+        "index": ForegroundIndex(fg_databases),
+    }
+
+
+def _tagged_traversal_init(project, demand, method, fg_databases):
+    """Build one ``LCA`` and foreground index per worker process."""
+    if projects.current != project:
+        projects.set_current(project)
+    _worker_state.update(_tagged_traversal_state(demand, method, fg_databases))
+
+
+def _tagged_traversal_scores(functional_unit, kwargs, state=None):
+    """Traverse one functional unit, and return its aggregated tag scores.
+
+    Uses the worker process state unless ``state`` is given."""
+    if state is None:
+        state = _worker_state
+    graph = [
+        recurse_tagged_database(
+            key,
+            amount,
+            state["method_dict"],
+            state["lca"],
+            unit_scores=state["unit_scores"],
+            index=state["index"],
+            **kwargs
+        )
+        for key, amount in functional_unit.items()
+    ]
+    return dict(aggregate_tagged_graph(graph))
+
+
+def traverse_tagged_databases_batch(
+    functional_units,
+    method,
+    label="tag",
+    default_tag="other",
+    secondary_tags=[],
+    fg_databases=None,
+    workers=None,
+    names=None,
+):
+    """Traverse many functional units with ``traverse_tagged_databases``, and return their aggregated tag scores as one table.
+
+    The LCA of all functional units together is calculated once, and each traversal only looks up scores from the unit scores of this LCA. With ``workers``, the functional units are distributed over a pool of processes, each of which does this setup once.
+
+    Input arguments:
+
+        * ``functional_units``: A list of functional unit dictionaries, e.g. ``[{("foo", "bar"): 42}, {("foo", "baz"): 1}]``.
+        * ``method``: A method name, e.g. ``("foo", "bar")``
+        * ``label``, ``default_tag``, ``secondary_tags``, ``fg_databases``: See ``traverse_tagged_databases``.
+        * ``workers``: Number of worker processes. Default is to traverse in this process.
+        * ``names``: Optional list of scenario names, used as the table index.
+
+    Returns:
+
+        A pandas ``DataFrame`` with one row per functional unit and one column per tag.
+
+    """
+    functional_units = list(functional_units)
+    demand = {key: 1 for functional_unit in functional_units for key in functional_unit}
+    scope = _index_databases(demand, fg_databases)
+    kwargs = {
+        "label": label,
+        "default_tag": default_tag,
+        "secondary_tags": secondary_tags,
+        "fg_databases": fg_databases,
+    }
+
+    if workers:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_tagged_traversal_init,
+            initargs=(projects.current, demand, method, scope),
+        ) as executor:
+            scores = list(
+                executor.map(_tagged_traversal_scores, functional_units, repeat(kwargs))
+            )
+    else:
+        state = _tagged_traversal_state(demand, method, scope)
+        scores = [
+            _tagged_traversal_scores(functional_unit, kwargs, state)
+            for functional_unit in functional_units
+        ]
+
+    return pd.DataFrame(scores, index=names).fillna(0)
+
+
 def aggregate_tagged_graph(graph):
     """Aggregate a graph produced by ``recurse_tagged_database`` by the provided tags.
 
@@ -91,7 +250,11 @@ def aggregate_tagged_graph(graph):
 
         {'a tag': summed LCIA scores}
 
+    ``graph`` can also be a ``TaggedGraphArrays``.
+
     """
+    if isinstance(graph, TaggedGraphArrays):
+        return graph.aggregate()
 
     def recursor(obj, scores):
         scores[obj["tag"]] += obj["impact"]
@@ -107,8 +270,150 @@ def aggregate_tagged_graph(graph):
     return scores
 
 
+class _IndexedExchange:
+    """Read-only stand-in for an ``Exchange`` whose input activity is already loaded."""
+
+    def __init__(self, data, input):
+        self._data = data
+        self.input = input
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+
+class ForegroundIndex:
+    """In-memory index of the activities and exchanges of the foreground databases.
+
+    All exchanges of ``fg_databases`` are loaded with one query, and all their activities and input activities with one query per database, so that ``recurse_tagged_database`` doesn't need to query the database for each visited activity. Create a new index if the databases change."""
+
+    def __init__(self, fg_databases, chunk_size=500):
+        self.databases = set(fg_databases)
+        self.activities = {
+            ds.key: Activity(ds)
+            for ds in ActivityDataset.select().where(
+                ActivityDataset.database << list(self.databases)
+            )
+        }
+
+        documents = list(
+            ExchangeDataset.select()
+            .where(ExchangeDataset.output_database << list(self.databases))
+            .order_by(ExchangeDataset.id)
+        )
+        missing = defaultdict(set)
+        for doc in documents:
+            if (doc.input_database, doc.input_code) not in self.activities:
+                missing[doc.input_database].add(doc.input_code)
+        for database, codes in missing.items():
+            codes = sorted(codes)
+            for start in range(0, len(codes), chunk_size):
+                for ds in ActivityDataset.select().where(
+                    ActivityDataset.database == database,
+                    ActivityDataset.code << codes[start : start + chunk_size],
+                ):
+                    self.activities[ds.key] = Activity(ds)
+
+        self._exchanges = defaultdict(list)
+        for doc in documents:
+            data = doc.data
+            data["input"] = (doc.input_database, doc.input_code)
+            data["output"] = (doc.output_database, doc.output_code)
+            self._exchanges[data["output"], doc.type].append(
+                _IndexedExchange(data, self.activities[data["input"]])
+            )
+
+    def __len__(self):
+        return len(self.activities)
+
+    def get_activity(self, key):
+        try:
+            return self.activities[key]
+        except KeyError:
+            return get_activity(key)
+
+    def exchanges(self, activity, kind):
+        """List of exchanges of type ``kind`` (e.g. ``"technosphere"``) of ``activity``, ordered by database row id."""
+        return self._exchanges.get((activity.key, kind), [])
+
+    def get_field(self, activity, key, default=None):
+        """Like ``activity.get(key, default)``, but without querying the database.
+
+        Looks in the activity data, its ``classifications`` and ``properties``, and then in the ``classifications`` and ``properties`` of its indexed production exchange, like ``Activity.__getitem__``."""
+        data = activity._data
+        if key in data:
+            return data[key]
+        sources = [data]
+        production = self.exchanges(activity, "production")
+        if len(production) == 1:
+            sources.append(production[0]._data)
+        for source in sources:
+            for section in ("classifications", "properties"):
+                values = source.get(section)
+                if isinstance(values, list):
+                    values = {k: v for k, v in values}
+                if values and key in values:
+                    return values[key]
+        return default
+
+
+class TaggedResultCache:
+    """Bounded cache of the tagged results of ``recurse_tagged_database`` for one unit of an activity, keyed by foreground databases and activity id.
+
+    The least recently used result is evicted when more than ``maxsize`` results are stored. Cached results are only valid for the traversal arguments (method, tags) they were calculated with, so use a new cache for each traversal."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def _scale_tagged_result(result, amount):
+    """Copy of a ``recurse_tagged_database`` result for one unit, with amounts and impacts multiplied by ``amount``."""
+    if result is None:
+        return None
+    return {
+        "activity": result["activity"],
+        "amount": result["amount"] * amount,
+        "tag": result["tag"],
+        "secondary_tags": list(result["secondary_tags"]),
+        "impact": result["impact"] * amount,
+        "biosphere": [
+            dict(
+                flow,
+                amount=flow["amount"] * amount,
+                impact=flow["impact"] * amount,
+                secondary_tags=list(flow["secondary_tags"]),
+            )
+            for flow in result["biosphere"]
+        ],
+        "technosphere": [_scale_tagged_result(exc, amount) for exc in result["technosphere"]],
+    }
+
+
 def recurse_tagged_database(
-    activity, amount, method_dict, lca, label, default_tag, secondary_tags=[], fg_databases=None, warned=False
+    activity, amount, method_dict, lca, label, default_tag, secondary_tags=[], fg_databases=None, warned=False,
+    unit_scores=None, cache=None, index=None,
 ):
 
     """Traverse a foreground database and assess activities and biosphere flows by tags.
@@ -126,6 +431,9 @@ def recurse_tagged_database(
         
         * ``fg_databases``: a list of foreground databases to be traversed, e.g. ['foreground', 'biomass', 'machinery']
                             It's not recommended to include all databases of a project in the list to be traversed, especially not ecoinvent itself
+        * ``unit_scores``: Optional array of the LCA scores of one unit of each product, in the order of ``lca.dicts.product``, e.g. from ``bw2analyzer.utils._unit_scores(lca)``. If given, inputs from outside the foreground are scored by lookup instead of ``lca.redo_lcia``.
+        * ``index``: Optional ``ForegroundIndex`` of (at least) ``fg_databases``. If given, activities and exchanges are read from this index instead of being queried from the database.
+        * ``cache``: Optional ``TaggedResultCache``. Results are calculated for one unit of each activity, stored, and rescaled to ``amount`` each time the activity is visited.
 
     Returns:
 
@@ -148,19 +456,101 @@ def recurse_tagged_database(
 
     """
     if isinstance(activity, tuple):
-        activity = get_activity(activity)
+        activity = get_activity(activity) if index is None else index.get_activity(activity)
+
+    context = _TraversalContext(
+        method_dict, lca, label, default_tag, secondary_tags,
+        # Default is the database of the functional unit
+        fg_databases or [activity["database"]],
+        check_size=fg_databases is not None and not warned,
+        unit_scores=unit_scores, cache=cache, index=index,
+    )
+    return _recurse_tagged(activity, amount, context)
+
+
+class _TraversalContext:
+    """Arguments and state shared by all nodes of one ``recurse_tagged_database`` traversal.
+
+    The foreground scope is resolved once into a frozen set of database names. If ``check_size``, its number of activities is counted once, and a warning is given if it is large."""
 
     MESSAGE = """Given databases include many activities, and traversal may be slow.
 Consider using `GraphTraversalLCA` from `bw2calc` instead."""
 
-    if fg_databases is None:  # then set the list equal to the database of the functional unit
-        fg_databases = [activity['database']]  # list, single item
-    elif not warned and sum(len(Database(name)) for name in fg_databases) > 2500:
-        warn(MESSAGE)
-        warned = True
+    def __init__(
+        self, method_dict, lca, label, default_tag, secondary_tags, fg_databases,
+        check_size=False, unit_scores=None, cache=None, index=None,
+    ):
+        self.method_dict = method_dict
+        self.lca = lca
+        self.label = label
+        self.default_tag = default_tag
+        self.secondary_tags = secondary_tags
+        self.fg_databases = frozenset(fg_databases)
+        self.unit_scores = unit_scores
+        self.cache = cache
+        self.index = index
+        self.size = None
+        if check_size:
+            if index is not None and self.fg_databases <= index.databases:
+                self.size = sum(
+                    1
+                    for database, _ in index.activities
+                    if database in self.fg_databases
+                )
+            else:
+                self.size = sum(len(Database(name)) for name in self.fg_databases)
+            if self.size > 2500:
+                warn(self.MESSAGE)
+
+
+def _recurse_tagged(activity, amount, context, fill_cache=False):
+    """Recursion of ``recurse_tagged_database`` with a ``_TraversalContext``."""
+    if context.cache is not None and not fill_cache:
+        # Starting nodes in different databases can have different scopes
+        key = (context.fg_databases, activity.id)
+        unit_result = context.cache.get(key)
+        if unit_result is None:
+            unit_result = _recurse_tagged(activity, 1, context, fill_cache=True)
+            if unit_result is None:
+                return
+            context.cache.put(key, unit_result)
+        return _scale_tagged_result(unit_result, amount)
+
+    assessed = _assess_tagged(activity, amount, context)
+    if assessed is None:
+        return
+    node, inside = assessed
+    node["technosphere"] = [
+        _recurse_tagged(input_, input_amount, context)
+        for input_, input_amount in inside
+    ]
+    return node
 
-    inputs = list(activity.technosphere())
-    production = list(activity.production())
+
+def _assess_tagged(activity, amount, context):
+    """Assess one activity of a tagged traversal, without its foreground inputs.
+
+    Returns the ``recurse_tagged_database`` dictionary without ``technosphere``, and a list of ``(input activity, amount)`` for the foreground inputs; or ``None`` if the activity has multiple production exchanges."""
+    label, default_tag, fg_databases = (
+        context.label,
+        context.default_tag,
+        context.fg_databases,
+    )
+
+    # Activities outside the index, e.g. a functional unit activity which
+    # isn't in ``fg_databases``, are queried from the database
+    index = context.index
+    if index is not None and activity["database"] not in index.databases:
+        index = None
+
+    if index is not None:
+        inputs = index.exchanges(activity, "technosphere")
+        production = index.exchanges(activity, "production")
+        biosphere = index.exchanges(activity, "biosphere")
+    else:
+        inputs = list(activity.technosphere())
+        production = list(activity.production())
+        biosphere = activity.biosphere()
 
     if not production:
         scale = 1
@@ -169,7 +559,7 @@ Consider using `GraphTraversalLCA` from `bw2calc` instead."""
         return
     else:
         scale = production[0]["amount"]
-        for other in activity.technosphere():
+        for other in inputs:
             if other.input == production[0].input:
                 scale -= other["amount"]
 
@@ -181,17 +571,32 @@ Consider using `GraphTraversalLCA` from `bw2calc` instead."""
         if exc["input"][0] not in fg_databases
     }
 
-    if outside:
-        lca.redo_lcia(outside)
-        outside_score = lca.score
+    if outside and context.unit_scores is not None:
+        outside_score = sum(
+            value * context.unit_scores[context.lca.dicts.product[key]]
+            for key, value in outside.items()
+        )
+    elif outside:
+        context.lca.redo_lcia(outside)
+        outside_score = context.lca.score
     else:
         outside_score = 0
 
+    # ``Activity.get`` queries the production exchange for missing fields
+    if index is not None:
+        tag = index.get_field(activity, label)
+        secondary = [index.get_field(activity, t[0]) for t in context.secondary_tags]
+    else:
+        tag = activity.get(label)
+        secondary = [activity.get(t[0]) for t in context.secondary_tags]
+
     return {
         "activity": activity,
         "amount": amount,
-        "tag": activity.get(label) or default_tag,
-        "secondary_tags": [activity.get(t[0]) or t[1] for t in secondary_tags],
+        "tag": tag or default_tag,
+        "secondary_tags": [
+            value or t[1] for value, t in zip(secondary, context.secondary_tags)
+        ],
         "impact": outside_score,
         "biosphere": [
             {
@@ -200,36 +605,102 @@ Consider using `GraphTraversalLCA` from `bw2calc` instead."""
                 "impact": exc["amount"]
                 / scale
                 * amount
-                * method_dict.get(exc["input"], 0),
-                "tag": exc.get(label) or activity.get(label) or default_tag,
+                * context.method_dict.get(exc["input"], 0),
+                "tag": exc.get(label) or tag or default_tag,
                 "secondary_tags": [
-                    exc.get(t[0]) or activity.get(t[0]) or t[1] for t in secondary_tags
+                    exc.get(t[0]) or value or t[1]
+                    for value, t in zip(secondary, context.secondary_tags)
                 ],
             }
-            for exc in activity.biosphere()
+            for exc in biosphere
         ],
-        "technosphere": [
-            recurse_tagged_database(
-                activity=exc.input,
-                amount=exc["amount"] / scale * amount,
-                method_dict=method_dict,
-                lca=lca,
-                label=label,
-                default_tag=default_tag,
-                secondary_tags=secondary_tags,
-                fg_databases=fg_databases,
-                warned=warned,
+    }, [(exc.input, exc["amount"] / scale * amount) for exc in inside]
+
+
+TaggedRecord = namedtuple(
+    "TaggedRecord",
+    ["path", "activity_id", "amount", "tag", "secondary_tags", "impact"],
+)
+
+
+def iterate_tagged_databases(
+    functional_unit, method, label="tag", default_tag="other", secondary_tags=[], fg_databases=None,
+    totals=None,
+):
+    """Traverse a functional unit like ``traverse_tagged_databases``, but lazily yield one flat record per activity and biosphere flow instead of building the nested graph.
+
+    Uses an explicit stack, so only the records waiting to be yielded are held in memory, and records can be written to disk as the traversal proceeds. Each record is a ``TaggedRecord`` named tuple of ``(path, activity_id, amount, tag, secondary_tags, impact)``. ``path`` is the tuple of activity ids from the functional unit activity to this activity or biosphere flow. For activities, ``impact`` is the impact of the inputs from outside the foreground.
+
+    Input arguments:
+
+        * ``functional_unit``, ``method``, ``label``, ``default_tag``, ``secondary_tags``, ``fg_databases``: See ``traverse_tagged_databases``.
+        * ``totals``: Optional dictionary, which is updated with the running sum of impacts by primary tag as records are yielded.
+
+    Yields:
+
+        ``TaggedRecord`` named tuples, depth-first.
+
+    Raises ``ValueError`` if the foreground has a cycle.
+
+    """
+    demand = {key: 1 for key in functional_unit}
+    state = _tagged_traversal_state(
+        demand, method, _index_databases(demand, fg_databases)
+    )
+
+    for key, amount in functional_unit.items():
+        activity = state["index"].get_activity(key) if isinstance(key, tuple) else key
+        context = _TraversalContext(
+            state["method_dict"], state["lca"], label, default_tag, secondary_tags,
+            fg_databases or [activity["database"]],
+            check_size=fg_databases is not None,
+            unit_scores=state["unit_scores"], index=state["index"],
+        )
+
+        stack = [(activity, amount, ())]
+        while stack:
+            activity, amount, path = stack.pop()
+            assessed = _assess_tagged(activity, amount, context)
+            if assessed is None:
+                continue
+            node, inside = assessed
+            path = path + (activity.id,)
+            records = [
+                TaggedRecord(
+                    path,
+                    activity.id,
+                    amount,
+                    node["tag"],
+                    node["secondary_tags"],
+                    node["impact"],
+                )
+            ] + [
+                TaggedRecord(
+                    path + (flow["activity"].id,),
+                    flow["activity"].id,
+                    flow["amount"],
+                    flow["tag"],
+                    flow["secondary_tags"],
+                    flow["impact"],
+                )
+                for flow in node["biosphere"]
+            ]
+            for record in records:
+                if totals is not None:
+                    totals[record.tag] = totals.get(record.tag, 0) + record.impact
+                yield record
+            _check_tagged_cycle(inside, path)
+            stack.extend(
+                (input_, input_amount, path)
+                for input_, input_amount in reversed(inside)
             )
-            for exc in inside
-        ],
-    }
 
 
 ## tagged graph functions using multiple methods
 
 
 def multi_traverse_tagged_databases(
-    functional_unit, methods, label="tag", default_tag="other", secondary_tags=[]
+    functional_unit, methods, label="tag", default_tag="other", secondary_tags=[], compact=False
 ):
 
     """Traverse a functional unit throughout its foreground database(s), and
@@ -241,6 +712,7 @@ def multi_traverse_tagged_databases(
         * ``label``: The label of the tag classifier. Default is ``"tag"``
         * ``default_tag``: The tag classifier to use if none was given. Default is ``"other"``
         * ``secondary_tags``: List of tuples in the format (secondary_label, secondary_default_tag). Default is empty list.
+        * ``compact``: Return the tagged supply chain graph as ``TaggedGraphArrays`` instead of nested dictionaries. The arrays are filled during the traversal, so the nested graph is never built. Default is ``False``.
 
     Returns:
 
@@ -249,14 +721,37 @@ def multi_traverse_tagged_databases(
     """
 
     lca = LCA(functional_unit, methods[0])
-    lca.lci()  # factorize=True)
-    lca.lcia()
+    lca.load_lci_data()
+    lca.load_lcia_data()
 
     method_dicts = [{o[0]: o[1] for o in Method(method).load()} for method in methods]
+    # Unit scores of each product for all methods from one multi-RHS solve
+    unit_scores = _unit_scores(
+        lca, characterization=_stacked_characterization(lca, methods)
+    )
+
+    if compact:
+        # Fill the arrays node by node instead of building the nested graph
+        assess = partial(
+            _assess_multi_tagged,
+            methods=methods,
+            method_dicts=method_dicts,
+            lca=lca,
+            label=label,
+            default_tag=default_tag,
+            secondary_tags=secondary_tags,
+            unit_scores=unit_scores,
+        )
+        graph = _compact_tagged_traversal(
+            (get_activity(key) if isinstance(key, tuple) else key, amount, assess)
+            for key, amount in functional_unit.items()
+        )
+        return multi_aggregate_tagged_graph(graph), graph
 
     graph = [
         multi_recurse_tagged_database(
-            key, amount, methods, method_dicts, lca, label, default_tag, secondary_tags
+            key, amount, methods, method_dicts, lca, label, default_tag, secondary_tags,
+            unit_scores=unit_scores,
         )
         for key, amount in functional_unit.items()
     ]
@@ -276,7 +771,11 @@ def multi_aggregate_tagged_graph(graph):
 
         {'a tag': [list of summed LCIA scores with one sum per method]}
 
+    ``graph`` can also be a ``TaggedGraphArrays``.
+
     """
+    if isinstance(graph, TaggedGraphArrays):
+        return graph.aggregate()
 
     def recursor(obj, scores):
         if not scores.get(obj["tag"]):
@@ -305,7 +804,8 @@ def multi_aggregate_tagged_graph(graph):
 
 
 def multi_recurse_tagged_database(
-    activity, amount, methods, method_dicts, lca, label, default_tag, secondary_tags=[]
+    activity, amount, methods, method_dicts, lca, label, default_tag, secondary_tags=[],
+    unit_scores=None,
 ):
 
     """Traverse a foreground database and assess activities and biosphere flows by tags using multiple methods.
@@ -320,6 +820,7 @@ def multi_recurse_tagged_database(
         * ``label``: string
         * ``default_tag``: string
         * ``secondary_tags``: list of tuples in the format (secondary_label, secondary_default_tag). Default is empty list.
+        * ``unit_scores``: Optional ``(products, methods)`` array of the LCA scores of one unit of each product for each method, e.g. from ``bw2analyzer.utils._unit_scores`` with a stacked characterization matrix. If given, inputs from outside the foreground are scored by lookup instead of ``lca.switch_method`` and ``lca.redo_lcia`` for each method.
 
     Returns:
 
@@ -345,6 +846,34 @@ def multi_recurse_tagged_database(
     if isinstance(activity, tuple):
         activity = get_activity(activity)
 
+    node, inside = _assess_multi_tagged(
+        activity, amount, methods, method_dicts, lca, label, default_tag, secondary_tags,
+        unit_scores=unit_scores,
+    )
+    node["technosphere"] = [
+        multi_recurse_tagged_database(
+            input_,
+            input_amount,
+            methods,
+            method_dicts,
+            lca,
+            label,
+            default_tag,
+            secondary_tags,
+            unit_scores=unit_scores,
+        )
+        for input_, input_amount in inside
+    ]
+    return node
+
+
+def _assess_multi_tagged(
+    activity, amount, methods, method_dicts, lca, label, default_tag, secondary_tags=[],
+    unit_scores=None,
+):
+    """Assess one activity of a multi method tagged traversal, without its foreground inputs.
+
+    Returns the ``multi_recurse_tagged_database`` dictionary without ``technosphere``, and a list of ``(input activity, amount)`` for the foreground inputs."""
     inputs = list(activity.technosphere())
     inside = [exc for exc in inputs if exc.input["database"] == activity["database"]]
     outside = {
@@ -353,7 +882,10 @@ def multi_recurse_tagged_database(
         if exc["input"][0] != activity["database"]
     }
 
-    if outside:
+    if outside and unit_scores is not None:
+        rows = [lca.dicts.product[key] for key in outside]
+        outside_scores = (np.array(list(outside.values())) @ unit_scores[rows]).tolist()
+    elif outside:
         outside_scores = []
         for n, m in enumerate(methods):
             lca.switch_method(m)
@@ -383,152 +915,348 @@ def multi_recurse_tagged_database(
             }
             for exc in activity.biosphere()
         ],
-        "technosphere": [
-            multi_recurse_tagged_database(
-                exc.input,
-                exc["amount"] * amount,
-                methods,
-                method_dicts,
-                lca,
-                label,
-                default_tag,
-                secondary_tags,
-            )
-            for exc in inside
-        ],
-    }
-
-
-def get_cum_impact(graph, max_levels=100):
+    }, [(exc.input, exc["amount"] * amount) for exc in inside]
+
+
+def _copy_tagged_graph(graph):
+    """Copy the node dictionaries of a tagged graph, so that they can be changed without changing ``graph``. Other values are not copied."""
+    copied = [dict(node) for node in graph]
+    stack = list(copied)
+    while stack:
+        node = stack.pop()
+        node["technosphere"] = [dict(exc) for exc in node["technosphere"]]
+        stack.extend(node["technosphere"])
+    return copied
+
+
+def _add_cum_impact(graph, zero, add, inplace):
+    """Add ``cum_impact`` to each node of a tagged graph in one post-order pass.
+
+    The cumulative impact of a node is the sum of its biosphere impacts, and the impacts and cumulative impacts of its technosphere inputs. ``zero`` returns the starting value for a node, and ``add`` adds two impacts."""
+    if not inplace:
+        graph = _copy_tagged_graph(graph)
+    for root in graph:
+        # Reversed pre-order visits all inputs of a node before the node itself
+        order, stack = [], [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(node["technosphere"])
+        for node in reversed(order):
+            cum_impact = zero(node)
+            for flow in node["biosphere"]:
+                cum_impact = add(cum_impact, flow["impact"])
+            for exc in node["technosphere"]:
+                cum_impact = add(add(cum_impact, exc["impact"]), exc["cum_impact"])
+            node["cum_impact"] = cum_impact
+    return graph
+
+
+def get_cum_impact(graph, max_levels=None, inplace=False):
 
     """Add cumulative impact ``cum_impact`` to each ``technosphere`` level of a tagged graph.
 
-    This function recurses until all levels in the graph have been checked, or the ``max_levels`` cutoff is reached
+    The cumulative impacts are calculated bottom-up in a single pass through the graph.
 
     Input arguments:
         * ``graph``: A tagged supply chain graph from ``recurse_tagged_database``.
-        * ``max_levels``: maximum number of graph levels to check before giving up. Default is 100.
+        * ``max_levels``: Ignored; kept for backwards compatibility. All levels are always calculated.
+        * ``inplace``: Add ``cum_impact`` to the nodes of ``graph`` instead of to a copy. Default is ``False``.
 
     Returns:
          Tagged supply chain graph with additional cumulative impact ``cum_impact`` key at each ``technosphere`` level.
     """
+    return _add_cum_impact(
+        graph,
+        zero=lambda node: 0,
+        add=lambda first, second: first + second,
+        inplace=inplace,
+    )
 
-    def cum_impact_recurse(d):
 
-        to_return = {}
-        cum_impact = 0
+def get_multi_cum_impact(graph, max_levels=None, inplace=False):
 
-        for k, v in d.items():
-            if k == "technosphere":
-                if len(v) != 0:
-                    for e in v:
-                        cum_impact += e["impact"]
-                        if "cum_impact" in e.keys():
-                            cum_impact += e["cum_impact"]
+    """Add cumulative impact ``cum_impact`` to each ``technosphere`` level of a multi method tagged graph.
 
-                        if k in to_return.keys():
-                            to_return[k].append(cum_impact_recurse(e))
-                        else:
-                            to_return[k] = [cum_impact_recurse(e)]
-                else:
-                    to_return[k] = []
+    The cumulative impacts are calculated bottom-up in a single pass through the graph.
 
-            elif k == "biosphere":
-                to_return[k] = v
-                if len(v) != 0:
-                    for b in v:
-                        cum_impact += b["impact"]
+    Input arguments:
+        * ``graph``: A tagged supply chain graph from ``multi_recurse_tagged_database``.
+        * ``max_levels``: Ignored; kept for backwards compatibility. All levels are always calculated.
+        * ``inplace``: Add ``cum_impact`` to the nodes of ``graph`` instead of to a copy. Default is ``False``.
 
-            # elif k == 'activity':
-            #    to_return[k] = str(v)
+    Returns:
+         Tagged supply chain graph with additional cumulative impact ``cum_impact`` key at each ``technosphere`` level.
+    """
+    return _add_cum_impact(
+        graph,
+        zero=lambda node: [0] * len(node["impact"]),
+        add=lambda first, second: [x + y for x, y in zip(first, second)],
+        inplace=inplace,
+    )
 
-            else:
-                to_return[k] = v
 
-        to_return["cum_impact"] = cum_impact
+## compact tagged graphs
 
-        return to_return
 
-    return_list = []
+class TaggedGraphArrays:
+    """Tagged supply chain graph stored in flat NumPy arrays.
 
-    for subgraph in graph:
+    Holds the same information as the nested dictionaries from ``recurse_tagged_database`` or ``multi_recurse_tagged_database``, but with one array element per activity or biosphere flow, and integer codes instead of tag strings. This uses much less memory than dictionaries with ``Activity`` objects, and can be pickled quickly.
 
-        this_d = subgraph
+    Elements are ordered depth-first, so each parent comes before its inputs. Each activity is followed by its biosphere flows, and then by its technosphere inputs.
 
-        for i in range(max_levels):
-            prev_d = this_d
-            this_d = cum_impact_recurse(prev_d)
-            if this_d == prev_d:
-                break
+    Attributes:
 
-        return_list.append(this_d)
+        * ``parent``: Index of the consuming activity, or -1 for the functional unit activities
+        * ``activity_id``: Activity or biosphere flow id
+        * ``amount``: Amount
+        * ``tag``: Code of the primary tag
+        * ``secondary_tags``: ``(elements, secondary tags)`` array of secondary tag codes
+        * ``impact``: Impact, or ``(elements, methods)`` array of impacts for multiple methods
+        * ``kind``: ``TaggedGraphArrays.ACTIVITY`` or ``TaggedGraphArrays.BIOSPHERE``
+        * ``tags``: List of tag labels; codes are indices in this list
 
-    return return_list
+    """
 
+    ACTIVITY = 0
+    BIOSPHERE = 1
+
+    def __init__(
+        self, parent, activity_id, amount, tag, secondary_tags, impact, kind, tags
+    ):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.activity_id = np.asarray(activity_id, dtype=np.int64)
+        self.amount = np.asarray(amount, dtype=np.float64)
+        self.tag = np.asarray(tag, dtype=np.int32)
+        self.secondary_tags = np.asarray(secondary_tags, dtype=np.int32)
+        if self.secondary_tags.ndim < 2:
+            self.secondary_tags = self.secondary_tags.reshape(len(self.parent), 0)
+        self.impact = np.asarray(impact, dtype=np.float64)
+        self.kind = np.asarray(kind, dtype=np.int8)
+        self.tags = list(tags)
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_nested(cls, graph):
+        """Convert a tagged graph of nested dictionaries."""
+        builder = _TaggedGraphBuilder()
+        stack = [(node, -1) for node in reversed(graph)]
+        while stack:
+            node, parent = stack.pop()
+            if node is None:
+                continue
+            index = builder.add_node(parent, node)
+            stack.extend((exc, index) for exc in reversed(node["technosphere"]))
+        return builder.finish()
+
+    def to_nested(self):
+        """Convert to the nested dictionaries of ``recurse_tagged_database``.
+
+        All activities are loaded with one query per 500 activities."""
+        activities = _activities_by_id(self.activity_id)
+        impacts = self.impact.tolist()
+        graph, nodes = [], {}
+        columns = enumerate(
+            zip(
+                self.parent.tolist(),
+                self.activity_id.tolist(),
+                self.amount.tolist(),
+                self.tag.tolist(),
+                self.secondary_tags.tolist(),
+                self.kind.tolist(),
+            )
+        )
+        for index, (parent, activity_id, amount, tag, secondary_tags, kind) in columns:
+            element = {
+                "activity": activities[activity_id],
+                "amount": amount,
+                "tag": self.tags[tag],
+                "secondary_tags": [self.tags[code] for code in secondary_tags],
+                "impact": impacts[index],
+            }
+            if kind == self.BIOSPHERE:
+                nodes[parent]["biosphere"].append(element)
+                continue
+            element["biosphere"], element["technosphere"] = [], []
+            nodes[index] = element
+            if parent < 0:
+                graph.append(element)
+            else:
+                nodes[parent]["technosphere"].append(element)
+        return graph
 
-def get_multi_cum_impact(graph, max_levels=100):
+    def aggregate(self):
+        """Sum impacts by primary tag with ``np.bincount``.
 
-    """Add cumulative impact ``cum_impact`` to each ``technosphere`` level of a multi method tagged graph.
+        Returns a dictionary of tags to summed impacts, or to lists of summed impacts with one element per method."""
+        if self.impact.ndim == 1:
+            summed = np.bincount(
+                self.tag, weights=self.impact, minlength=len(self.tags)
+            ).tolist()
+        else:
+            summed = np.stack(
+                [
+                    np.bincount(self.tag, weights=column, minlength=len(self.tags))
+                    for column in self.impact.T
+                ],
+                axis=1,
+            ).tolist()
+        present = np.zeros(len(self.tags), dtype=bool)
+        present[self.tag] = True
+        return defaultdict(
+            int,
+            (
+                (tag, summed[code])
+                for code, tag in enumerate(self.tags)
+                if present[code]
+            ),
+        )
 
-    This function recurses until all levels in the graph have been checked, or the ``max_levels`` cutoff is reached
 
-    Input arguments:
-        * ``graph``: A tagged supply chain graph from ``multi_recurse_tagged_database``.
-        * ``max_levels``: maximum number of graph levels to check before giving up. Default is 100.
+class _TaggedGraphBuilder:
+    """Collect the elements of a ``TaggedGraphArrays`` one node at a time."""
 
-    Returns:
-         Tagged supply chain graph with additional cumulative impact ``cum_impact`` key at each ``technosphere`` level.
-    """
+    def __init__(self):
+        self.tags = {}
+        self.rows = []
 
-    def multi_cum_impact_recurse(d):
-
-        to_return = {}
-        cum_impact = [0] * len(d["impact"])
-
-        for k, v in d.items():
-            if k == "technosphere":
-                if len(v) != 0:
-                    for e in v:
-                        cum_impact = [sum(x) for x in zip(cum_impact, e["impact"])]
-                        if "cum_impact" in e.keys():
-                            cum_impact = [
-                                sum(x) for x in zip(cum_impact, e["cum_impact"])
-                            ]
-
-                        if k in to_return.keys():
-                            to_return[k].append(multi_cum_impact_recurse(e))
-                        else:
-                            to_return[k] = [multi_cum_impact_recurse(e)]
-                else:
-                    to_return[k] = []
-
-            elif k == "biosphere":
-                to_return[k] = v
-                if len(v) != 0:
-                    for b in v:
-                        cum_impact = [sum(x) for x in zip(cum_impact, b["impact"])]
-
-            # elif k == 'activity':
-            #    to_return[k] = str(v)
+    def _code(self, tag):
+        return self.tags.setdefault(tag, len(self.tags))
 
-            else:
-                to_return[k] = v
-        to_return["cum_impact"] = cum_impact
+    def _add(self, parent, element, kind):
+        self.rows.append(
+            (
+                parent,
+                element["activity"].id,
+                element["amount"],
+                self._code(element["tag"]),
+                [self._code(tag) for tag in element["secondary_tags"]],
+                element["impact"],
+                kind,
+            )
+        )
 
-        return to_return
+    def add_node(self, parent, node):
+        """Add an activity node and its biosphere flows; ``node["technosphere"]`` is ignored. Returns the index of the node."""
+        index = len(self.rows)
+        self._add(parent, node, TaggedGraphArrays.ACTIVITY)
+        for flow in node["biosphere"]:
+            self._add(index, flow, TaggedGraphArrays.BIOSPHERE)
+        return index
+
+    def finish(self):
+        columns = list(zip(*self.rows)) if self.rows else [[]] * 7
+        return TaggedGraphArrays(*columns, tags=sorted(self.tags, key=self.tags.get))
+
+
+def _compact_tagged_traversal(roots):
+    """Traverse tagged supply chains depth-first directly into a ``TaggedGraphArrays``.
+
+    ``roots`` are tuples of ``(activity, amount, assess)``, where ``assess(activity, amount)`` works like ``_assess_tagged``. Only the node being assessed is held as a dictionary.
+
+    Raises ``ValueError`` if the foreground has a cycle."""
+    builder = _TaggedGraphBuilder()
+    for activity, amount, assess in roots:
+        stack = [(activity, amount, -1, ())]
+        while stack:
+            activity, amount, parent, path = stack.pop()
+            assessed = assess(activity, amount)
+            if assessed is None:
+                continue
+            node, inside = assessed
+            index = builder.add_node(parent, node)
+            path = path + (activity.id,)
+            _check_tagged_cycle(inside, path)
+            stack.extend(
+                (input_, input_amount, index, path)
+                for input_, input_amount in reversed(inside)
+            )
+    return builder.finish()
 
-    return_list = []
 
-    for subgraph in graph:
+def _check_tagged_cycle(inside, path):
+    """Raise ``ValueError`` if one of the foreground inputs ``inside`` is already on ``path``, the activity ids from the functional unit activity to their consumer."""
+    for input_, _ in inside:
+        if input_.id in path:
+            raise ValueError(
+                "Cycle in foreground supply chain: {} consumes itself".format(input_)
+            )
 
-        this_d = subgraph
 
-        for i in range(max_levels):
-            prev_d = this_d
-            this_d = multi_cum_impact_recurse(prev_d)
-            if this_d == prev_d:
-                break
+def group_tagged_graph(
+    graph, by=("tag",), columns=None, secondary_tags=[], methods=None, as_array=False
+):
+    """Sum the impacts of a tagged graph by any combination of primary and secondary tags in one pass.
 
-        return_list.append(this_d)
+    Unlike ``aggregate_tagged_graph``, this can group by secondary tags, and by several tags at once. All elements (activities and biosphere flows) are assigned to their tag combination, and summed with one sparse matrix product with the ``(elements, methods)`` impact matrix, so graphs from ``multi_recurse_tagged_database`` are grouped for all methods at once.
+
+    Input arguments:
 
-    return return_list
+        * ``graph``: Tagged supply chain graph from ``recurse_tagged_database`` or ``multi_recurse_tagged_database``, or ``TaggedGraphArrays``.
+        * ``by``: Tags to group by. ``"tag"`` is the primary tag; secondary tags are given by their label in ``secondary_tags``.
+        * ``columns``: Optional tag whose values become the columns of the returned ``DataFrame``, i.e. a cross-tabulation with ``by``.
+        * ``secondary_tags``: The ``secondary_tags`` argument used for the traversal, i.e. a list of tuples in the format (secondary_label, secondary_default_tag).
+        * ``methods``: Optional list of method names, used as column labels. Default is ``"impact"`` for single method graphs, and the method index otherwise.
+        * ``as_array``: Return a dense array instead of a ``DataFrame``.
+
+    Returns:
+
+        A pandas ``DataFrame`` with the grouped tags as (multi-)index, and methods as columns (or methods and ``columns`` tags as column multi-index). If ``as_array``, a tuple of a dense array with one axis per grouped tag plus one axis for methods, and a list of the tag labels along each tag axis.
+
+    """
+    if not isinstance(graph, TaggedGraphArrays):
+        graph = TaggedGraphArrays.from_nested(graph)
+
+    names = ["tag"] + [label for label, _ in secondary_tags]
+    groups = list(by) + ([columns] if columns is not None else [])
+    if not by:
+        raise ValueError("Give at least one tag to group by")
+    for name in groups:
+        if name not in names:
+            raise ValueError(
+                "Unknown tag {}; give secondary tags with `secondary_tags`".format(name)
+            )
+    codes = np.column_stack([graph.tag, graph.secondary_tags])[
+        :, [names.index(name) for name in groups]
+    ].reshape(len(graph), len(groups))
+    impacts = graph.impact.reshape(len(graph), -1)
+    if methods is None:
+        methods = (
+            ["impact"] if graph.impact.ndim == 1 else list(range(impacts.shape[1]))
+        )
+
+    if as_array:
+        # Positions along each tag axis, and flattened positions in the dense array
+        axes = [np.unique(column, return_inverse=True) for column in codes.T]
+        shape = tuple(len(values) for values, _ in axes)
+        group = np.ravel_multi_index([inverse.ravel() for _, inverse in axes], shape)
+        size = int(np.prod(shape))
+    else:
+        unique, group = np.unique(codes, axis=0, return_inverse=True)
+        group = group.ravel()
+        size = len(unique)
+
+    grouping = sparse.csr_matrix(
+        (np.ones(len(graph)), (group, np.arange(len(graph)))),
+        shape=(size, len(graph)),
+    )
+    summed = np.asarray(grouping @ impacts)
+
+    if as_array:
+        labels = [[graph.tags[code] for code in values] for values, _ in axes]
+        return summed.reshape(shape + (impacts.shape[1],)), labels
+
+    index = pd.MultiIndex.from_arrays(
+        [[graph.tags[code] for code in column] for column in unique.T], names=groups
+    )
+    df = pd.DataFrame(summed, index=index, columns=methods)
+    if columns is not None:
+        df = df.unstack(columns, fill_value=0)
+        if len(methods) == 1:
+            df = df[methods[0]]
+    elif len(groups) == 1:
+        df.index = df.index.get_level_values(0)
+    return df
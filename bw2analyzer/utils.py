@@ -1,88 +1,802 @@
+import hashlib
 import itertools
+import os
 import string
 import sys
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
 from warnings import warn
 
 import bw2calc as bc
 import numpy as np
 import pandas as pd
 import pyprind
-from bw2data import Database, databases, get_activity, methods
+from bw2data import Database, databases, get_activity, projects
+from bw2data import methods as bw2data_methods
+from bw2data.backends import Activity, ActivityDataset
+from scipy import sparse
+from scipy.sparse.linalg import splu
 
 
-def contribution_for_all_datasets_one_method(database, method, progress=True):
-    """Calculate contribution analysis (for technosphere processes) for all inventory datasets in one database for one LCIA method.
+def _factorized_technosphere(lca):
+    """Factorize the technosphere matrix of ``lca``.
+
+    Unlike ``LCA.decompose_technosphere``, the returned ``SuperLU`` object can solve many demand vectors in one call, and can also solve the transposed system."""
+    return splu(lca.technosphere_matrix.tocsc())
+
+
+def _unit_scores(lca, solver=None, characterization=None):
+    """Calculate the cumulative LCIA score of one unit of each product in ``lca``.
+
+    LCA is linear, so the score of any demand ``d`` is ``d . z``, where ``z`` solves the transposed system :math:`A^{T}z = (CB)^{T}1`. One solve therefore gives the scores of all products. Normalization and weighting are not applied.
 
     Args:
-        *database* (str): Name of database
-        *method* (tuple): Method tuple
+        *lca* (``LCA``): LCA object which has already done LCI and LCIA.
+        *solver* (``SuperLU``, optional): Factorized technosphere matrix.
+        *characterization* (``scipy.sparse`` matrix, optional): Stacked ``(methods, biosphere flows)`` characterization matrix from ``_stacked_characterization``. If given, the unit scores for all methods are calculated with one multi-RHS solve.
 
     Returns:
-        NumPy array of relative contributions. Each column sums to one.
-        Lookup dictionary, dataset keys to row/column indices
+        NumPy array of unit scores, indexed by ``lca.dicts.product``. If ``characterization`` is given, the array has shape ``(products, methods)``.
 
     """
+    if solver is None:
+        solver = _factorized_technosphere(lca)
+    if characterization is not None:
+        weights = (characterization * lca.biosphere_matrix).toarray()
+        return solver.solve(np.ascontiguousarray(weights.T), trans="T")
+    weights = np.array(
+        (lca.characterization_matrix * lca.biosphere_matrix).sum(axis=0)
+    ).ravel()
+    return solver.solve(weights, trans="T")
+
+
+def _normalized_columns(data):
+    """Normalize the absolute values in each column of ``data`` to sum to one. Columns which sum to zero are returned as zeros."""
+    scores = np.abs(data)
+    summed = scores.sum(axis=0)
+    return np.divide(scores, summed, out=np.zeros(scores.shape), where=summed != 0)
+
+
+def _stacked_characterization(lca, methods):
+    """Stack the characterization factors of ``methods`` into one sparse ``(methods, biosphere flows)`` matrix.
+
+    Uses ``lca.switch_method``, so the ``lca`` object is left with the last method."""
+    rows = []
+    for method in methods:
+        if method != lca.method:
+            lca.switch_method(method)
+        rows.append(sparse.csr_matrix(lca.characterization_matrix.diagonal()))
+    return sparse.vstack(rows).tocsr()
+
+
+def _characterized_biosphere_values(characterization, biosphere):
+    """Characterize each non-zero biosphere matrix value with each method.
+
+    Returns the biosphere matrix in COO format, and a dense ``(methods, biosphere values)`` array."""
+    coo = biosphere.tocoo()
+    return coo, characterization[:, coo.row].toarray() * coo.data
+
+
+def _contribution_blocks(lca, solver, characterization, activity_ids, batch_size=256):
+    """Generate normalized contribution blocks for many unit demands and LCIA methods at once.
+
+    Builds ``batch_size`` demand vectors at a time, solves them against the already factorized technosphere matrix in one multi-RHS call, and calculates the "activities", "flows", and "all" contributions for the whole block with vectorized NumPy. Each inventory is calculated once, and then characterized with every method.
+
+    Args:
+        *lca* (``LCA``): LCA object which has already done LCI.
+        *solver* (``SuperLU``): Factorized technosphere matrix.
+        *characterization* (sparse matrix): Stacked characterization factors, from ``_stacked_characterization``.
+        *activity_ids* (list): Activity ids to calculate.
+        *batch_size* (int): Number of demand vectors to solve at once.
+
+    Yields:
+        Tuples of ``(ids, blocks)``, where ``ids`` are the activity ids in this block, and ``blocks`` is a list with one ``(columns, results)`` tuple per method. ``columns`` are the activity column indices with non-zero scores, and ``results`` is a dictionary with the normalized "activities", "flows", and "all" values of these columns. The "all" values are sorted in descending order.
+
+    """
+    biosphere = lca.biosphere_matrix.tocsr()
+    activity_cfs = (characterization * biosphere).toarray()
+    coo, values = _characterized_biosphere_values(characterization, biosphere)
+    characterization = characterization.toarray()
+
+    for start in range(0, len(activity_ids), batch_size):
+        ids = activity_ids[start : start + batch_size]
+        demand = np.zeros((len(lca.dicts.product), len(ids)))
+        demand[[lca.dicts.product[id_] for id_ in ids], np.arange(len(ids))] = 1
+        supply = solver.solve(demand)
+        inventory = biosphere * supply
+        all_columns = np.array([lca.dicts.activity[id_] for id_ in ids], dtype=int)
+
+        blocks = []
+        for index in range(characterization.shape[0]):
+            flows = characterization[index].reshape((-1, 1)) * inventory
+            mask = flows.sum(axis=0) != 0
+            nonzero = values[index] != 0
+
+            all_ = _normalized_columns(
+                values[index, nonzero].reshape((-1, 1))
+                * supply[coo.col[nonzero], :][:, mask]
+            )
+            all_.sort(axis=0)
+
+            blocks.append(
+                (
+                    all_columns[mask],
+                    {
+                        "activities": _normalized_columns(
+                            activity_cfs[index].reshape((-1, 1)) * supply[:, mask]
+                        ),
+                        "flows": _normalized_columns(flows[:, mask]),
+                        "all": all_[::-1, :],
+                    },
+                )
+            )
+        yield ids, blocks
+
+
+# Per-process state of the worker processes in ``contribution_for_all_datasets_many_methods``
+_worker_state = {}
+
+
+def _contribution_worker_init(project, demand, methods):
+    """Build and factorize one ``LCA`` per worker process."""
+    if projects.current != project:
+        projects.set_current(project)
+    lca = bc.LCA(demand, method=methods[0])
+    lca.load_lci_data()
+    lca.load_lcia_data()
+    _worker_state["lca"] = lca
+    _worker_state["solver"] = _factorized_technosphere(lca)
+    _worker_state["characterization"] = _stacked_characterization(lca, methods)
+
+
+def _contribution_worker(activity_ids):
+    """Calculate one block of unit demands in a worker process.
+
+    Only the results for these columns are sent back to the parent process."""
+    return next(
+        _contribution_blocks(
+            _worker_state["lca"],
+            _worker_state["solver"],
+            _worker_state["characterization"],
+            activity_ids,
+            batch_size=len(activity_ids),
+        )
+    )
+
+
+def _parallel_contribution_blocks(demand, methods, activity_ids, batch_size, workers):
+    """Like ``_contribution_blocks``, but shards the blocks across ``workers`` processes.
+
+    Blocks are yielded in the order they are completed. At most ``2 * workers`` blocks are submitted at a time, and each future is dropped once its block is yielded, so finished results don't pile up in memory."""
+    starts = iter(range(0, len(activity_ids), batch_size))
+    pending = set()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_contribution_worker_init,
+        initargs=(projects.current, demand, methods),
+    ) as executor:
+        while True:
+            for start in itertools.islice(starts, 2 * workers - len(pending)):
+                pending.add(
+                    executor.submit(
+                        _contribution_worker, activity_ids[start : start + batch_size]
+                    )
+                )
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            while done:
+                yield done.pop().result()
 
-    def get_normalized_scores(lca, kind):
-        if kind == "activities":
-            data = lca.characterized_inventory.sum(axis=0)
-        elif kind == "flows":
-            data = lca.characterized_inventory.sum(axis=1)
-        elif kind == "all":
-            data = lca.characterized_inventory.data
-        scores = np.abs(np.array(data).ravel())
-        summed = scores.sum()
-        if summed == 0:
-            return np.zeros(scores.shape)
+
+class _DenseContributionStore:
+    """Store contribution results in dense ``float32`` arrays, optionally memory-mapped to ``{prefix}{kind}.npy`` files in ``directory``.
+
+    Existing memory-mapped files are reused if ``resume``."""
+
+    def __init__(self, shapes, directory=None, resume=False, prefix=""):
+        if directory is None:
+            self.results = {
+                kind: np.zeros(shape, dtype=np.float32)
+                for kind, shape in shapes.items()
+            }
         else:
-            return scores / summed
+            self.results = {}
+            for kind, shape in shapes.items():
+                filepath = Path(directory) / f"{prefix}{kind}.npy"
+                self.results[kind] = np.lib.format.open_memmap(
+                    filepath,
+                    mode="r+" if resume and filepath.is_file() else "w+",
+                    dtype=np.float32,
+                    shape=shape,
+                )
+
+    def write(self, columns, block):
+        for kind, data in block.items():
+            self.results[kind][: data.shape[0], columns] = data
+
+    def state(self):
+        """Arrays needed to restore this store from a checkpoint. Memory-mapped arrays are flushed instead."""
+        state = {}
+        for kind, array in self.results.items():
+            if isinstance(array, np.memmap):
+                array.flush()
+            else:
+                state[kind] = array
+        return state
+
+    def restore(self, state):
+        for kind, array in self.results.items():
+            if not isinstance(array, np.memmap):
+                array[:] = state[kind]
+
+    def finalize(self):
+        self.state()
+        return self.results
+
+
+class _TopKContributionStore:
+    """Store only the ``top_k`` largest contributions of each column, and return them as sparse CSC matrices."""
+
+    def __init__(self, shapes, top_k=25):
+        self.shapes, self.top_k = shapes, top_k
+        self.pieces = {kind: [] for kind in shapes}
+
+    def write(self, columns, block):
+        for kind, data in block.items():
+            if kind == "all":
+                # Already sorted in descending order
+                rows = np.arange(min(self.top_k, data.shape[0]))
+                rows = np.broadcast_to(rows.reshape((-1, 1)), (len(rows), len(columns)))
+            elif data.shape[0] > self.top_k:
+                rows = np.argpartition(-data, self.top_k - 1, axis=0)[: self.top_k]
+            else:
+                rows = np.broadcast_to(
+                    np.arange(data.shape[0]).reshape((-1, 1)), data.shape
+                )
+            values = np.take_along_axis(data, rows, axis=0)
+            cols = np.broadcast_to(columns, values.shape)
+            mask = values != 0
+            self.pieces[kind].append(
+                (
+                    values[mask].astype(np.float32),
+                    rows[mask],
+                    cols[mask],
+                )
+            )
+
+    def _concatenated(self, kind):
+        if self.pieces[kind]:
+            self.pieces[kind] = [tuple(np.hstack(x) for x in zip(*self.pieces[kind]))]
+        else:
+            self.pieces[kind] = [
+                (np.zeros(0, dtype=np.float32), np.zeros(0, int), np.zeros(0, int))
+            ]
+        return self.pieces[kind][0]
+
+    def state(self):
+        """Arrays needed to restore this store from a checkpoint."""
+        state = {}
+        for kind in self.shapes:
+            for label, array in zip(
+                ("values", "rows", "cols"), self._concatenated(kind)
+            ):
+                state[f"{kind}_{label}"] = array
+        return state
+
+    def restore(self, state):
+        for kind in self.shapes:
+            self.pieces[kind] = [
+                tuple(state[f"{kind}_{label}"] for label in ("values", "rows", "cols"))
+            ]
+
+    def finalize(self):
+        results = {}
+        for kind, shape in self.shapes.items():
+            values, rows, cols = self._concatenated(kind)
+            results[kind] = sparse.csc_matrix((values, (rows, cols)), shape=shape)
+        return results
+
+
+def _save_checkpoint(filepath, stores, done):
+    """Atomically write the state of ``stores`` and the completed activity ids ``done`` to ``filepath``."""
+    state = {
+        f"{index}_{label}": array
+        for index, store in enumerate(stores)
+        for label, array in store.state().items()
+    }
+    temp_filepath = filepath.with_suffix(".tmp.npz")
+    np.savez(temp_filepath, _done=np.array(done, dtype=int), **state)
+    os.replace(temp_filepath, filepath)
+
+
+def _load_checkpoint(filepath, stores):
+    """Restore ``stores`` from the checkpoint at ``filepath``, and return the completed activity ids."""
+    with np.load(filepath) as state:
+        for index, store in enumerate(stores):
+            prefix = f"{index}_"
+            store.restore(
+                {
+                    label[len(prefix) :]: state[label]
+                    for label in state.files
+                    if label.startswith(prefix)
+                }
+            )
+        return state["_done"].tolist()
+
+
+def _contribution_sweep(
+    database,
+    methods,
+    progress,
+    batch_size,
+    workers,
+    output,
+    directory,
+    top_k,
+    checkpoint_every,
+    file_prefixes,
+):
+    """Shared implementation of ``contribution_for_all_datasets_one_method`` and ``contribution_for_all_datasets_many_methods``.
 
+    Returns a list of results dictionaries, one per method."""
+    if output not in ("dense", "memmap", "sparse"):
+        raise ValueError(f"Unknown output mode {output}")
     assert database in databases, f"Can't find database {database}"
-    assert method in methods, f"Can't find method {method}"
+    for method in methods:
+        assert method in bw2data_methods, f"Can't find method {method}"
     db = Database(database)
     assert len(db), f"Database {database} appears to have no datasets"
 
-    # Array to store results
-    results = np.zeros((len(db), len(db)), dtype=np.float32)
-
     # Instantiate LCA object
-    lca = bc.LCA({db.random(): 1}, method=method)
-    lca.lci()
-    lca.lcia()
-
-    rows = lca.characterized_inventory.shape[0]
-    cols = lca.characterized_inventory.shape[1]
-    all_cutoff = cols * 4
-
-    results = {
-        "activities": np.zeros((cols, cols), dtype=np.float32),
-        "flows": np.zeros((rows, cols), dtype=np.float32),
-        "all": np.zeros((all_cutoff, cols), dtype=np.float32),
-    }
+    demand = {db.random().key: 1}
+    lca = bc.LCA(demand, method=methods[0])
+    lca.load_lci_data()
+    lca.load_lcia_data()
+    characterization = _stacked_characterization(lca, methods)
+    _, values = _characterized_biosphere_values(characterization, lca.biosphere_matrix)
+
+    rows, cols = lca.biosphere_matrix.shape
+    shapes = [
+        {
+            "activities": (cols, cols),
+            "flows": (rows, cols),
+            "all": (int((values[index] != 0).sum()), cols),
+        }
+        for index in range(len(methods))
+    ]
+
+    if output == "memmap":
+        directory = directory or projects.request_directory("contribution_analysis")
+
+    if checkpoint_every:
+        key = (
+            database,
+            tuple(tuple(method) for method in methods),
+            databases[database].get("modified"),
+            output,
+        )
+        if output == "memmap":
+            key += (str(Path(directory).absolute()),)
+        elif output == "sparse":
+            key += (top_k,)
+        checkpoint = projects.request_directory("contribution_checkpoints") / (
+            hashlib.md5(repr(key).encode("utf-8")).hexdigest() + ".npz"
+        )
+    resume = checkpoint_every and checkpoint.is_file()
+
+    if output == "dense":
+        stores = [_DenseContributionStore(shape) for shape in shapes]
+    elif output == "memmap":
+        stores = [
+            _DenseContributionStore(shape, directory, resume=resume, prefix=prefix)
+            for shape, prefix in zip(shapes, file_prefixes)
+        ]
+    else:
+        stores = [_TopKContributionStore(shape, top_k) for shape in shapes]
 
-    pbar = pyprind.ProgBar(len(db), title="Activities:")
+    done = _load_checkpoint(checkpoint, stores) if resume else []
+
+    skip = set(done)
+    activity_ids = [
+        ds.id for ds in db if ds.id in lca.dicts.product and ds.id not in skip
+    ]
+    if progress:
+        pbar = pyprind.ProgBar(len(activity_ids), title="Activities:")
 
     # Actual calculations
-    for ds in db:
-        lca.redo_lcia({ds.id: 1})
-        if not lca.score:
+    if workers and workers > 1:
+        batches = _parallel_contribution_blocks(
+            demand, methods, activity_ids, batch_size, workers
+        )
+    else:
+        batches = _contribution_blocks(
+            lca,
+            _factorized_technosphere(lca),
+            characterization,
+            activity_ids,
+            batch_size,
+        )
+    for count, (ids, blocks) in enumerate(batches, start=1):
+        for store, (columns, block) in zip(stores, blocks):
+            store.write(columns, block)
+        done.extend(ids)
+        if checkpoint_every and not count % checkpoint_every:
+            _save_checkpoint(checkpoint, stores, done)
+
+        if progress:
+            pbar.update(len(ids))
+
+    if checkpoint_every and checkpoint.is_file():
+        checkpoint.unlink()
+
+    if progress:
+        print(pbar)
+
+    return [store.finalize() for store in stores]
+
+
+def contribution_for_all_datasets_one_method(
+    database,
+    method,
+    progress=True,
+    batch_size=256,
+    workers=None,
+    output="dense",
+    directory=None,
+    top_k=25,
+    checkpoint_every=None,
+):
+    """Calculate contribution analysis (for technosphere processes) for all inventory datasets in one database for one LCIA method.
+
+    The technosphere matrix is factorized once, and demand vectors are solved ``batch_size`` at a time. If ``workers`` is given, the blocks of demand vectors are distributed over a pool of processes, each of which builds and factorizes its own ``LCA`` once.
+
+    The ``output`` mode determines how results are stored:
+
+    * ``dense``: In-memory ``float32`` arrays.
+    * ``memmap``: ``float32`` arrays memory-mapped to ``.npy`` files in ``directory`` (default is the ``contribution_analysis`` project directory). Existing files are overwritten. Load them again with ``numpy.load(filepath, mmap_mode="r")``.
+    * ``sparse``: Only the ``top_k`` largest values of each column, as ``scipy.sparse.csc_matrix``. Memory use scales with ``top_k`` instead of the number of datasets.
+
+    If ``checkpoint_every`` is given, the completed activities and partial results are saved to the ``contribution_checkpoints`` project directory every ``checkpoint_every`` blocks. Calling this function again with the same database, method, and output options resumes from the last checkpoint, as long as the database wasn't modified in the meantime. The checkpoint is deleted when the calculation finishes.
+
+    The "all" results have one row for each non-zero value in the characterized biosphere matrix, which is the maximum number of non-zero values in a characterized inventory.
+
+    Args:
+        *database* (str): Name of database
+        *method* (tuple): Method tuple
+        *progress* (bool): Display a progress bar
+        *batch_size* (int): Number of datasets to calculate in one multi-RHS solve
+        *workers* (int, optional): Number of worker processes to use
+        *output* (str): One of ``dense``, ``memmap``, or ``sparse``
+        *directory* (str, optional): Directory for ``memmap`` output
+        *top_k* (int): Number of values per column to keep for ``sparse`` output
+        *checkpoint_every* (int, optional): Number of blocks between checkpoints
+
+    Returns:
+        Dictionary of relative contributions, with keys "activities", "flows", and "all". Each column sums to one, unless ``sparse`` output drops values.
+
+    """
+    return _contribution_sweep(
+        database=database,
+        methods=[method],
+        progress=progress,
+        batch_size=batch_size,
+        workers=workers,
+        output=output,
+        directory=directory,
+        top_k=top_k,
+        checkpoint_every=checkpoint_every,
+        file_prefixes=[""],
+    )[0]
+
+
+def contribution_for_all_datasets_many_methods(
+    database,
+    methods,
+    progress=True,
+    batch_size=256,
+    workers=None,
+    output="sparse",
+    directory=None,
+    top_k=25,
+    checkpoint_every=None,
+):
+    """Calculate contribution analysis (for technosphere processes) for all inventory datasets in one database for many LCIA methods.
+
+    Works like ``contribution_for_all_datasets_one_method``, but each life cycle inventory is only calculated once. The characterization factors of all methods are stacked into one sparse matrix, and all methods are applied to each block of inventories in the same pass.
+
+    The default ``output`` mode is ``sparse``, so memory use scales with ``top_k`` instead of the number of methods times the number of datasets squared. ``memmap`` output files are named ``{method index}-{kind}.npy``, where the method index is the position in ``methods``.
+
+    Args:
+        *database* (str): Name of database
+        *methods* (list): List of method tuples
+        *progress* (bool): Display a progress bar
+        *batch_size* (int): Number of datasets to calculate in one multi-RHS solve
+        *workers* (int, optional): Number of worker processes to use
+        *output* (str): One of ``dense``, ``memmap``, or ``sparse``
+        *directory* (str, optional): Directory for ``memmap`` output
+        *top_k* (int): Number of values per column to keep for ``sparse`` output
+        *checkpoint_every* (int, optional): Number of blocks between checkpoints
+
+    Returns:
+        Dictionary with method tuples as keys, and dictionaries of relative contributions (as returned by ``contribution_for_all_datasets_one_method``) as values.
+
+    """
+    methods = [tuple(method) for method in methods]
+    results = _contribution_sweep(
+        database=database,
+        methods=methods,
+        progress=progress,
+        batch_size=batch_size,
+        workers=workers,
+        output=output,
+        directory=directory,
+        top_k=top_k,
+        checkpoint_every=checkpoint_every,
+        file_prefixes=[f"{index}-" for index in range(len(methods))],
+    )
+    return dict(zip(methods, results))
+
+
+def _technosphere_inputs(lca, technosphere, activity_id):
+    """Get the production amount and the inputs of an activity from its column in the technosphere matrix.
+
+    Args:
+        *lca* (``LCA``): LCA object which has already done LCI.
+        *technosphere* (``scipy.sparse.csc_matrix``): ``lca.technosphere_matrix`` in CSC format.
+        *activity_id* (int): Activity id.
+
+    Returns:
+        ``(production amount, [(input id, input amount)])``. Inputs are ordered by matrix row. Input amounts are the negative matrix values, so substitution appears as a negative input. Parallel exchanges between the same activities are summed, and self-consumption is subtracted from the production amount.
+
+    """
+    column = lca.dicts.activity[activity_id]
+    start, end = technosphere.indptr[column], technosphere.indptr[column + 1]
+    rows, values = technosphere.indices[start:end], technosphere.data[start:end]
+    production_row = lca.dicts.product[activity_id]
+
+    production = values[rows == production_row]
+    return (
+        production[0] if len(production) else 1,
+        [
+            (lca.dicts.product.reversed[row], -value)
+            for row, value in zip(rows, values)
+            if row != production_row and value != 0
+        ],
+    )
+
+
+def _exchange_inputs(activity, lca=None, use_matrix_values=False):
+    """Get the production amount and the inputs of an activity from its exchanges in the database.
+
+    Args:
+        *activity* (``Activity``): Activity to get inputs for.
+        *lca* (``LCA``, optional): If given, the production amount is taken from the technosphere matrix. Otherwise it is the production exchange amount minus any self-consumption.
+        *use_matrix_values* (bool): Take input amounts from ``lca.technosphere_matrix`` instead of the exchange ``amount``.
+
+    Returns:
+        ``(production amount, [(position, input activity, input amount)])``, where ``position`` is the index of the exchange in ``activity.technosphere()``. Self-consumption exchanges are skipped. Returns ``None`` if the activity has more than one production exchange.
+
+    """
+    prod_exchanges = list(activity.production())
+    technosphere = list(activity.technosphere())
+    if not prod_exchanges:
+        prod_amount = 1
+    elif len(prod_exchanges) > 1:
+        return None
+    elif lca is not None:
+        prod_amount = lca.technosphere_matrix[
+            lca.dicts.product[prod_exchanges[0].input.id],
+            lca.dicts.activity[prod_exchanges[0].output.id],
+        ]
+    else:
+        prod_amount = prod_exchanges[0]["amount"]
+        for other in technosphere:
+            if other.input == prod_exchanges[0].input:
+                prod_amount -= other["amount"]
+
+    inputs = []
+    for position, exc in enumerate(technosphere):
+        if exc.input.id == exc.output.id:
+            continue
+
+        if use_matrix_values:
+            sign = (
+                -1 if exc.get("type") in ("technosphere", "generic technosphere") else 1
+            )
+            tm_amount = (
+                lca.technosphere_matrix[
+                    lca.dicts.product[exc.input.id],
+                    lca.dicts.activity[exc.output.id],
+                ]
+                * sign
+            )
+        else:
+            tm_amount = exc["amount"]
+        inputs.append((position, exc.input, tm_amount))
+    return prod_amount, inputs
+
+
+def _child_label(label, position):
+    """Label of the input at ``position`` of the node labelled ``label``; the suffix is the ``position``-th value of ``infinite_alphabet``."""
+    suffix, position = "", position + 1
+    while position:
+        position, remainder = divmod(position - 1, 26)
+        suffix = string.ascii_lowercase[remainder] + suffix
+    return label + "_" + suffix if label else suffix
+
+
+SupplyChainRecord = namedtuple(
+    "SupplyChainRecord", ["level", "label", "parent", "amount", "score", "activity_id"]
+)
+
+
+def _traverse_supply_chain(
+    activity,
+    lcia_method=None,
+    amount=1,
+    max_level=3,
+    cutoff=1e-2,
+    root_label="root",
+    use_matrix_values=False,
+    use_unit_scores=None,
+    matrix_traversal=False,
+    _lca_obj=None,
+    _total_score=None,
+    _aborted=None,
+    _labels=True,
+    _scores=None,
+):
+    """Shared traversal core of ``iterate_supply_chain``, ``recursive_calculation_to_object`` and the ``print_recursive_*`` functions.
+
+    Yields tuples of ``(SupplyChainRecord, activity, parent index, position)``, where ``activity`` is the ``Activity`` if it was already loaded (``None`` otherwise), ``parent index`` is the number of the parent record in the yielded sequence (-1 for the root), and ``position`` is the index of the input exchange in the parent activity. Labels are only built if ``_labels`` is true. Scores are calculated if ``_scores`` is true, which is the default if ``lcia_method`` or ``_lca_obj`` is given. The numbers of records whose inputs were skipped because of multiple production exchanges are appended to ``_aborted``, if given."""
+    activity = get_activity(activity)
+    if _scores is None:
+        scoring = lcia_method is not None or _lca_obj is not None
+    else:
+        scoring = _scores
+    if matrix_traversal:
+        use_unit_scores = True
+    elif use_unit_scores is None:
+        use_unit_scores = _lca_obj is None
+    built = False
+
+    if scoring:
+        if _lca_obj is None:
+            _lca_obj = bc.LCA({activity: amount}, lcia_method)
+            _lca_obj.lci()
+            _lca_obj.lcia()
+            _total_score = _lca_obj.score
+            built = True
+        elif _total_score is None:
+            raise ValueError
+        unit_scores = _unit_scores(_lca_obj) if use_unit_scores else None
+    if matrix_traversal:
+        if _lca_obj is None:
+            _lca_obj = bc.LCA({activity: amount})
+            _lca_obj.load_lci_data()
+        technosphere = _lca_obj.technosphere_matrix.tocsc()
+
+    # Explicit stack of ``(level, label, parent label, parent index, position, activity or id, amount)``
+    stack = [(0, root_label if _labels else None, None, -1, 0, activity, amount)]
+    index = -1
+    while stack:
+        level, label, parent, parent_index, position, node, amount = stack.pop()
+        node_id = node if isinstance(node, int) else node.id
+
+        if not scoring:
+            score = None
+            if cutoff > 0 and amount < cutoff:
+                continue
+        elif level == 0 and built:
+            score = _total_score
+        else:
+            if use_unit_scores:
+                score = amount * unit_scores[_lca_obj.dicts.product[node_id]]
+            else:
+                _lca_obj.redo_lcia({node_id: amount})
+                score = _lca_obj.score
+            if abs(score) <= abs(_total_score * cutoff):
+                continue
+
+        index += 1
+        yield (
+            SupplyChainRecord(level, label, parent, float(amount), score, node_id),
+            None if isinstance(node, int) else node,
+            parent_index,
+            position,
+        )
+
+        if level >= max_level:
             continue
 
-        col = lca.dicts.activity[ds.id]
-        results["activities"][:, col] = get_normalized_scores(lca, "activities")
-        results["flows"][:, col] = get_normalized_scores(lca, "flows")
-        results_all = get_normalized_scores(lca, "all")
-        results_all.sort()
-        results_all = results_all[::-1]
-        fill_number = results_all.shape[0]
-        assert fill_number < all_cutoff, "Too many values in 'all'"
-        results["all"][:fill_number, col] = results_all
+        if matrix_traversal:
+            prod_amount, inputs = _technosphere_inputs(_lca_obj, technosphere, node_id)
+            inputs = [(position, *obj) for position, obj in enumerate(inputs)]
+        else:
+            found = _exchange_inputs(
+                node, _lca_obj if scoring else None, use_matrix_values and scoring
+            )
+            if found is None:
+                warn(
+                    "Hit multiple production exchanges for {}; aborting in this branch".format(
+                        node
+                    )
+                )
+                if _aborted is not None:
+                    _aborted.append(index)
+                continue
+            prod_amount, inputs = found
+
+        stack.extend(
+            (
+                level + 1,
+                _child_label(label, position) if _labels else None,
+                label,
+                index,
+                position,
+                input_,
+                amount * tm_amount / prod_amount,
+            )
+            for position, input_, tm_amount in reversed(inputs)
+        )
+
+
+def iterate_supply_chain(
+    activity,
+    lcia_method=None,
+    amount=1,
+    max_level=3,
+    cutoff=1e-2,
+    root_label="root",
+    use_matrix_values=False,
+    use_unit_scores=None,
+    matrix_traversal=False,
+    _lca_obj=None,
+    _total_score=None,
+):
+    """Traverse a supply chain graph depth-first, and lazily yield one record per visited node.
+
+    Uses an explicit stack instead of recursion, so deep supply chains don't hit the recursion limit. Records can be streamed, the traversal can be stopped early, and records can be passed directly to ``pandas.DataFrame``.
 
-        pbar.update()
+    Each record is a ``SupplyChainRecord`` named tuple of ``(level, label, parent, amount, score, activity_id)``. Labels start with ``root_label``, and add ``_a``, ``_b``, etc. for each input. ``parent`` is the label of the parent node.
 
-    print(pbar)
+    If ``lcia_method`` (or ``_lca_obj``) is given, the LCA score of each node is calculated, and nodes with an absolute score less than or equal to ``cutoff`` times the total score are skipped. Otherwise ``score`` is ``None``, and nodes with an ``amount`` less than ``cutoff`` are skipped.
 
-    return results
+    Args:
+        activity: ``Activity``. The starting point of the supply chain graph.
+        lcia_method: tuple, optional. LCIA method to use when traversing supply chain graph.
+        amount: int. Amount of ``activity`` to assess.
+        max_level: int. Maximum depth to traverse.
+        cutoff: float. Cutoff when deciding whether to traverse deeper, see above.
+        root_label: str. Label of the root node.
+        use_matrix_values: bool. Take exchange values from the matrix instead of the exchange instance ``amount``. Only used when calculating scores.
+        use_unit_scores: bool, optional. Calculate node scores from the cumulative unit scores of one solve of the transposed technosphere system, instead of solving the LCA again for each node. Default is ``True``, unless ``_lca_obj`` is given.
+        matrix_traversal: bool. Read the inputs of each activity from the columns of the technosphere matrix instead of querying exchanges from the database. Implies ``use_unit_scores``.
+
+    Normally internal args:
+        _lca_obj: ``LCA``. Can give an instance of the LCA class (e.g. when doing regionalized or Monte Carlo LCA)
+        _total_score: float. Needed if specifying ``_lca_obj``.
+
+    Yields:
+        ``SupplyChainRecord`` named tuples
+
+    """
+    for record, *_ in _traverse_supply_chain(
+        activity=activity,
+        lcia_method=lcia_method,
+        amount=amount,
+        max_level=max_level,
+        cutoff=cutoff,
+        root_label=root_label,
+        use_matrix_values=use_matrix_values,
+        use_unit_scores=use_unit_scores,
+        matrix_traversal=matrix_traversal,
+        _lca_obj=_lca_obj,
+        _total_score=_total_score,
+    ):
+        yield record
 
 
 def print_recursive_calculation(
@@ -94,15 +808,17 @@ def print_recursive_calculation(
     file_obj=None,
     tab_character="  ",
     use_matrix_values=False,
+    use_unit_scores=None,
+    matrix_traversal=False,
     _lca_obj=None,
     _total_score=None,
-    __level=0,
-    __first=True,
 ):
     """Traverse a supply chain graph, and calculate the LCA scores of each component. Prints the result with the format:
 
     {tab_character * level }{fraction of total score} ({absolute LCA score for this input} | {amount of input}) {input activity}
 
+    Lines are written to ``file_obj`` as soon as each node is calculated.
+
     Args:
         activity: ``Activity``. The starting point of the supply chain graph.
         lcia_method: tuple. LCIA method to use when traversing supply chain graph.
@@ -112,90 +828,50 @@ def print_recursive_calculation(
         file_obj: File-like object (supports ``.write``), optional. Output will be written to this object if provided.
         tab_character: str. Character to use to indicate indentation.
         use_matrix_values: bool. Take exchange values from the matrix instead of the exchange instance ``amount``. Useful for Monte Carlo, but can be incorrect if there is more than one exchange from the same pair of nodes.
+        use_unit_scores: bool, optional. Calculate the cumulative scores of all activities with one solve of the transposed technosphere system, and then only look up ``amount * unit score`` for each node, instead of solving the LCA again for each node. Default is ``True``, unless ``_lca_obj`` is given; only enable it for a custom ``_lca_obj`` if its score is ``characterization_matrix * biosphere_matrix * supply_array``.
+        matrix_traversal: bool. Read the inputs of each activity from the columns of the technosphere matrix instead of querying exchanges from the database. Much faster for large supply chains. Implies ``use_unit_scores``. Inputs are ordered by matrix row, and parallel exchanges between the same activities are summed.
 
     Normally internal args:
         _lca_obj: ``LCA``. Can give an instance of the LCA class (e.g. when doing regionalized or Monte Carlo LCA)
         _total_score: float. Needed if specifying ``_lca_obj``.
 
-    Internal args (used during recursion, do not touch);
-        __level: int.
-        __first: bool.
-
     Returns:
         Nothing. Prints to ``sys.stdout`` or ``file_obj``
 
     """
-    activity = get_activity(activity)
     if file_obj is None:
         file_obj = sys.stdout
 
-    if _lca_obj is None:
-        _lca_obj = bc.LCA({activity: amount}, lcia_method)
-        _lca_obj.lci()
-        _lca_obj.lcia()
-        _total_score = _lca_obj.score
-    elif _total_score is None:
-        raise ValueError
-    else:
-        _lca_obj.redo_lcia({activity.id: amount})
-        if abs(_lca_obj.score) <= abs(_total_score * cutoff):
-            return
-    if __first:
-        file_obj.write("Fraction of score | Absolute score | Amount | Activity\n")
-    message = "{}{:04.3g} | {:5.4n} | {:5.4n} | {:.70}".format(
-        tab_character * __level,
-        _lca_obj.score / _total_score,
-        _lca_obj.score,
-        float(amount),
-        str(activity),
-    )
-    file_obj.write(message + "\n")
-    if __level < max_level:
-        prod_exchanges = list(activity.production())
-        if not prod_exchanges:
-            prod_amount = 1
-        elif len(prod_exchanges) > 1:
-            warn("Hit multiple production exchanges; aborting in this branch")
-            return
-        else:
-            prod_amount = _lca_obj.technosphere_matrix[
-                _lca_obj.dicts.product[prod_exchanges[0].input.id],
-                _lca_obj.dicts.activity[prod_exchanges[0].output.id],
-            ]
-
-        for exc in activity.technosphere():
-            if exc.input.id == exc.output.id:
-                continue
-
-            if use_matrix_values:
-                sign = (
-                    -1
-                    if exc.get("type") in ("technosphere", "generic technosphere")
-                    else 1
-                )
-                tm_amount = (
-                    _lca_obj.technosphere_matrix[
-                        _lca_obj.dicts.product[exc.input.id],
-                        _lca_obj.dicts.activity[exc.output.id],
-                    ]
-                    * sign
-                )
-            else:
-                tm_amount = exc["amount"]
-
-            print_recursive_calculation(
-                activity=exc.input,
-                lcia_method=lcia_method,
-                amount=amount * tm_amount / prod_amount,
-                max_level=max_level,
-                cutoff=cutoff,
-                file_obj=file_obj,
-                tab_character=tab_character,
-                __first=False,
-                _lca_obj=_lca_obj,
-                _total_score=_total_score,
-                __level=__level + 1,
-            )
+    activities, first = {}, True
+    for record, activity_obj, *_ in _traverse_supply_chain(
+        activity=activity,
+        lcia_method=lcia_method,
+        amount=amount,
+        max_level=max_level,
+        cutoff=cutoff,
+        use_matrix_values=use_matrix_values,
+        use_unit_scores=use_unit_scores,
+        matrix_traversal=matrix_traversal,
+        _lca_obj=_lca_obj,
+        _total_score=_total_score,
+    ):
+        if first:
+            file_obj.write("Fraction of score | Absolute score | Amount | Activity\n")
+            total_score, first = record.score, False
+            if _total_score is not None:
+                total_score = _total_score
+        if activity_obj is None:
+            if record.activity_id not in activities:
+                activities[record.activity_id] = get_activity(record.activity_id)
+            activity_obj = activities[record.activity_id]
+        message = "{}{:04.3g} | {:5.4n} | {:5.4n} | {:.70}".format(
+            tab_character * record.level,
+            record.score / total_score,
+            record.score,
+            record.amount,
+            str(activity_obj),
+        )
+        file_obj.write(message + "\n")
 
 
 def print_recursive_supply_chain(
@@ -205,7 +881,8 @@ def print_recursive_supply_chain(
     cutoff=0,
     file_obj=None,
     tab_character="  ",
-    __level=0,
+    matrix_traversal=False,
+    lca=None,
 ):
     """Traverse a supply chain graph, and prints the inputs of each component.
 
@@ -220,45 +897,36 @@ def print_recursive_supply_chain(
         cutoff: float. Inputs with amounts less than ``amount * cutoff`` will not be printed or traversed further.
         file_obj: File-like object (supports ``.write``), optional. Output will be written to this object if provided.
         tab_character: str. Character to use to indicate indentation.
-        __level: int. Current level of the calculation. Only used internally, do not touch.
+        matrix_traversal: bool. Read the inputs of each activity from the columns of the technosphere matrix instead of querying exchanges from the database, and load all printed activities with one query at the end. Much faster for large supply chains. Inputs are ordered by matrix row, parallel exchanges between the same activities are summed, and substitution exchanges are shown as negative inputs.
+        lca: ``LCA``, optional. LCA object with loaded inventory data whose technosphere matrix is traversed if ``matrix_traversal``; can be reused for many calls. By default, the matrix is built for ``activity``.
 
     Returns:
         Nothing. Prints to ``stdout`` or ``file_obj``
 
     """
-    activity = get_activity(activity)
     if file_obj is None:
         file_obj = sys.stdout
 
-    if cutoff > 0 and amount < cutoff:
-        return
-    message = "{}{:.3g}: {:.70}".format(tab_character * __level, amount, str(activity))
-    file_obj.write(message + "\n")
-    if __level < max_level:
-        prod_exchanges = list(activity.production())
-        if not prod_exchanges:
-            prod_amount = 1
-        elif len(prod_exchanges) > 1:
-            warn("Hit multiple production exchanges; aborting in this branch")
-            return
-        else:
-            prod_amount = prod_exchanges[0]["amount"]
-            for other in activity.technosphere():
-                if other.input == prod_exchanges[0].input:
-                    prod_amount -= other["amount"]
+    traversal = _traverse_supply_chain(
+        activity=activity,
+        amount=amount,
+        max_level=max_level,
+        cutoff=cutoff,
+        matrix_traversal=matrix_traversal,
+        _lca_obj=lca if matrix_traversal else None,
+        _labels=False,
+        _scores=False,
+    )
+    if matrix_traversal:
+        records = [record for record, *_ in traversal]
+        activities = _activities_by_id(record.activity_id for record in records)
+        traversal = ((record, activities[record.activity_id]) for record in records)
 
-        for exc in activity.technosphere():
-            if exc.input.id == exc.output.id:
-                continue
-            print_recursive_supply_chain(
-                activity=exc.input,
-                amount=amount * exc["amount"] / prod_amount,
-                max_level=max_level,
-                cutoff=cutoff,
-                file_obj=file_obj,
-                tab_character=tab_character,
-                __level=__level + 1,
-            )
+    for record, activity_obj, *_ in traversal:
+        message = "{}{:.3g}: {:.70}".format(
+            tab_character * record.level, record.amount, str(activity_obj)
+        )
+        file_obj.write(message + "\n")
 
 
 def infinite_alphabet():
@@ -269,6 +937,248 @@ def infinite_alphabet():
         yield "".join(value)
 
 
+def _activities_by_id(ids, chunk_size=500):
+    """Load many activities with one ``IN`` query per ``chunk_size`` ids.
+
+    Returns a dictionary with activity ids as keys and ``Activity`` objects as values."""
+    ids = sorted({int(x) for x in ids})
+    activities = {}
+    for start in range(0, len(ids), chunk_size):
+        query = ActivityDataset.select().where(
+            ActivityDataset.id << ids[start : start + chunk_size]
+        )
+        for document in query:
+            activities[document.id] = Activity(document)
+    return activities
+
+
+class ActivityCache:
+    """Process-wide least recently used cache of ``Activity`` objects, keyed by activity id.
+
+    Each entry stores the ``modified`` timestamp of its database; entries are ignored once their database has been modified again.
+
+    Args:
+        maxsize: int. Maximum number of activities to keep.
+
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, id_):
+        try:
+            activity, modified = self._data[id_]
+        except KeyError:
+            return None
+        if databases.get(activity["database"], {}).get("modified") != modified:
+            del self._data[id_]
+            return None
+        self._data.move_to_end(id_)
+        return activity
+
+    def put(self, activity):
+        self._data[activity.id] = (
+            activity,
+            databases.get(activity["database"], {}).get("modified"),
+        )
+        self._data.move_to_end(activity.id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+activity_cache = ActivityCache()
+
+
+def resolve_activities(ids, use_cache=True):
+    """Load many activities by id, with one ``IN`` query for all activities which aren't in ``activity_cache``.
+
+    Args:
+        ids: Iterable of activity ids.
+        use_cache: bool. Use and fill the process-wide ``activity_cache``.
+
+    Returns:
+        Dictionary with activity ids as keys and ``Activity`` objects as values.
+
+    """
+    ids = {int(x) for x in ids}
+    if not use_cache:
+        return _activities_by_id(ids)
+
+    found = {}
+    for id_ in ids:
+        activity = activity_cache.get(id_)
+        if activity is not None:
+            found[id_] = activity
+    missing = _activities_by_id(ids.difference(found))
+    for activity in missing.values():
+        activity_cache.put(activity)
+    found.update(missing)
+    return found
+
+
+def _activity_metadata(ids, chunk_size=500):
+    """Get ``(name, database, code)`` for many activity ids with one ``IN`` query per ``chunk_size`` ids.
+
+    Returns a dictionary with activity ids as keys."""
+    ids = sorted({int(x) for x in ids})
+    metadata = {}
+    for start in range(0, len(ids), chunk_size):
+        query = ActivityDataset.select(
+            ActivityDataset.id,
+            ActivityDataset.name,
+            ActivityDataset.database,
+            ActivityDataset.code,
+        ).where(ActivityDataset.id << ids[start : start + chunk_size])
+        for id_, name, database, code in query.tuples():
+            metadata[id_] = (name, database, code)
+    return metadata
+
+
+class SupplyChainColumns:
+    """Columnar result of a supply chain traversal.
+
+    Records are stored in NumPy arrays, which grow by doubling: ``parent`` (index of the parent record, -1 for the root), ``position`` (index of the input exchange in the parent activity), ``level``, ``score``, ``amount``, and ``activity_id``. String labels, activity names and keys are only built when asked for, and names and keys are resolved with one bulk database query.
+
+    Args:
+        root_label: str. Label of the root record.
+        total_score: float, optional. Score used to calculate ``fraction``. Default is the score of the first record.
+        capacity: int. Number of records to preallocate.
+
+    """
+
+    _columns = (
+        ("parent", np.int64),
+        ("position", np.int64),
+        ("level", np.int32),
+        ("score", np.float64),
+        ("amount", np.float64),
+        ("activity_id", np.int64),
+    )
+
+    def __init__(self, root_label="root", total_score=None, capacity=1024):
+        self.root_label = root_label
+        self.total_score = total_score
+        self._size = 0
+        self._arrays = {
+            label: np.zeros(max(int(capacity), 1), dtype=dtype)
+            for label, dtype in self._columns
+        }
+        self._metadata = None
+
+    def __len__(self):
+        return self._size
+
+    def append(self, parent, position, level, score, amount, activity_id):
+        """Add one record."""
+        if self._size == len(self._arrays["parent"]):
+            for label, array in self._arrays.items():
+                self._arrays[label] = np.resize(array, 2 * len(array))
+        for label, value in zip(
+            ("parent", "position", "level", "score", "amount", "activity_id"),
+            (parent, position, level, score, amount, activity_id),
+        ):
+            self._arrays[label][self._size] = value
+        if self.total_score is None:
+            self.total_score = score
+        self._size += 1
+        self._metadata = None
+
+    def __getattr__(self, name):
+        if name in dict(self._columns):
+            return self._arrays[name][: self._size]
+        raise AttributeError(name)
+
+    @property
+    def fraction(self):
+        return self.score / self.total_score
+
+    @property
+    def labels(self):
+        """List of labels of the form ``root_a_b``. Parents always come before their inputs, so labels are built in one pass."""
+        labels = []
+        for parent, position in zip(self.parent.tolist(), self.position.tolist()):
+            if parent < 0:
+                labels.append(self.root_label)
+            else:
+                labels.append(_child_label(labels[parent], position))
+        return labels
+
+    @property
+    def parent_labels(self):
+        labels = self.labels
+        return [labels[parent] if parent >= 0 else None for parent in self.parent]
+
+    def _resolve(self):
+        if self._metadata is None:
+            self._metadata = _activity_metadata(self.activity_id)
+        return self._metadata
+
+    @property
+    def names(self):
+        metadata = self._resolve()
+        return [
+            metadata[id_][0] if metadata[id_][0] is not None else "(Unknown name)"
+            for id_ in self.activity_id.tolist()
+        ]
+
+    @property
+    def keys(self):
+        metadata = self._resolve()
+        return [tuple(metadata[id_][1:]) for id_ in self.activity_id.tolist()]
+
+    def to_dataframe(self):
+        """Return a pandas ``DataFrame`` with the same columns as ``recursive_calculation_to_object``."""
+        labels = self.labels
+        return pd.DataFrame(
+            {
+                "label": labels,
+                "parent": [
+                    labels[parent] if parent >= 0 else None for parent in self.parent
+                ],
+                "score": self.score,
+                "fraction": self.fraction,
+                "amount": self.amount,
+                "name": self.names,
+                "key": self.keys,
+            }
+        )
+
+    def to_arrow(self):
+        """Return a ``pyarrow.Table`` with the numeric columns, ``fraction``, ``label``, ``name``, ``database``, and ``code``. Requires ``pyarrow``."""
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("Exporting to Arrow requires `pyarrow`")
+
+        keys = self.keys
+        columns = {
+            label: self._arrays[label][: self._size] for label, _ in self._columns
+        }
+        columns.update(
+            {
+                "fraction": self.fraction,
+                "label": self.labels,
+                "name": self.names,
+                "database": [key[0] for key in keys],
+                "code": [key[1] for key in keys],
+            }
+        )
+        return pa.table(columns)
+
+    def to_parquet(self, filepath):
+        """Write the ``to_arrow`` table to a Parquet file. Requires ``pyarrow``."""
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), str(filepath))
+
+
 def recursive_calculation_to_object(
     activity,
     lcia_method,
@@ -278,23 +1188,21 @@ def recursive_calculation_to_object(
     as_dataframe=False,
     root_label="root",
     use_matrix_values=False,
+    use_unit_scores=None,
+    as_columns=False,
     _lca_obj=None,
     _total_score=None,
-    __result_list=None,
-    __level=0,
-    __label="",
-    __parent=None,
 ):
-    """Traverse a supply chain graph, and calculate the LCA scores of each component. Adds a dictionary to ``result_list`` of the form:
+    """Traverse a supply chain graph, and calculate the LCA scores of each component. Returns a list of dictionaries of the form:
 
         {
-            'label': Label of this branch. Starts with nothing, then A, AA, AB, AAA, AAB, etc.
+            'label': Label of this branch. Starts with ``root_label``, then root_a, root_b, root_a_a, root_a_b, etc.
+            'parent': Label of the parent branch
             'score': Absolute score of this activity
             'fraction': Fraction of total score of this activity
             'amount': Input amount of the reference product of this activity
             'name': Name of this activity
             'key': Activity key
-            'root_label': Starting label of root element for recursion.
         }
 
     Args:
@@ -304,98 +1212,68 @@ def recursive_calculation_to_object(
         max_level: int. Maximum depth to traverse.
         cutoff: float. Fraction of total score to use as cutoff when deciding whether to traverse deeper.
         as_dataframe: Return results as a list (default) or a pandas ``DataFrame``
+        root_label: str. Label of the root element.
         use_matrix_values: bool. Take exchange values from the matrix instead of the exchange instance ``amount``. Useful for Monte Carlo, but can be incorrect if there is more than one exchange from the same pair of nodes.
+        use_unit_scores: bool, optional. Calculate the cumulative scores of all activities with one solve of the transposed technosphere system, and then only look up ``amount * unit score`` for each node, instead of solving the LCA again for each node. Default is ``True``, unless ``_lca_obj`` is given; only enable it for a custom ``_lca_obj`` if its score is ``characterization_matrix * biosphere_matrix * supply_array``.
+        as_columns: bool. Return a ``SupplyChainColumns`` object, which stores the results in NumPy arrays and can be exported to Arrow or Parquet. ``as_dataframe`` also uses this columnar storage internally.
 
-    Internal args (used during recursion, do not touch):
-        __result_list: list.
-        __level: int.
-        __label: str.
-        __parent: str.
+    Normally internal args:
+        _lca_obj: ``LCA``. Can give an instance of the LCA class (e.g. when doing regionalized or Monte Carlo LCA)
+        _total_score: float. Needed if specifying ``_lca_obj``.
 
     Returns:
-        List of dicts
+        List of dicts, ``DataFrame``, or ``SupplyChainColumns``; or ``None`` if the starting activity has multiple production exchanges.
 
     """
-    activity = get_activity(activity)
-    if __result_list is None:
-        __result_list = []
-        __label = root_label
-
-    if _lca_obj is None:
-        _lca_obj = bc.LCA({activity: amount}, lcia_method)
-        _lca_obj.lci()
-        _lca_obj.lcia()
-        _total_score = _lca_obj.score
-    elif _total_score is None:
-        raise ValueError
-    else:
-        _lca_obj.redo_lcia({activity.id: amount})
-        if abs(_lca_obj.score) <= abs(_total_score * cutoff):
-            return
-    __result_list.append(
-        {
-            "label": __label,
-            "parent": __parent,
-            "score": _lca_obj.score,
-            "fraction": _lca_obj.score / _total_score,
-            "amount": float(amount),
-            "name": activity.get("name", "(Unknown name)"),
-            "key": activity.key,
-        }
+    aborted = []
+    traversal = _traverse_supply_chain(
+        activity=activity,
+        lcia_method=lcia_method,
+        amount=amount,
+        max_level=max_level,
+        cutoff=cutoff,
+        root_label=root_label,
+        use_matrix_values=use_matrix_values,
+        use_unit_scores=use_unit_scores,
+        _lca_obj=_lca_obj,
+        _total_score=_total_score,
+        _aborted=aborted,
+        _labels=not (as_dataframe or as_columns),
     )
-    if __level < max_level:
-        prod_exchanges = list(activity.production())
-        if not prod_exchanges:
-            prod_amount = 1
-        elif len(prod_exchanges) > 1:
-            warn(
-                "Hit multiple production exchanges for {}; aborting in this branch".format(
-                    activity
-                )
-            )
-            return
-        else:
-            prod_amount = _lca_obj.technosphere_matrix[
-                _lca_obj.dicts.product[prod_exchanges[0].input.id],
-                _lca_obj.dicts.activity[prod_exchanges[0].output.id],
-            ]
 
-        for child_label, exc in zip(infinite_alphabet(), activity.technosphere()):
-            if exc.input.id == exc.output.id:
-                continue
-
-            if use_matrix_values:
-                sign = (
-                    -1
-                    if exc.get("type") in ("technosphere", "generic technosphere")
-                    else 1
-                )
-                tm_amount = (
-                    _lca_obj.technosphere_matrix[
-                        _lca_obj.dicts.product[exc.input.id],
-                        _lca_obj.dicts.activity[exc.output.id],
-                    ]
-                    * sign
-                )
-            else:
-                tm_amount = exc["amount"]
-
-            recursive_calculation_to_object(
-                activity=exc.input,
-                lcia_method=lcia_method,
-                amount=amount * tm_amount / prod_amount,
-                max_level=max_level,
-                cutoff=cutoff,
-                as_dataframe=as_dataframe,
-                __result_list=__result_list,
-                __parent=__label,
-                __label=__label + "_" + child_label if __label else child_label,
-                _lca_obj=_lca_obj,
-                _total_score=_total_score,
-                __level=__level + 1,
+    if as_dataframe or as_columns:
+        result = SupplyChainColumns(root_label=root_label, total_score=_total_score)
+        for record, _, parent, position in traversal:
+            result.append(
+                parent,
+                position,
+                record.level,
+                record.score,
+                record.amount,
+                record.activity_id,
+            )
+    else:
+        result, total_score = [], _total_score
+        for record, activity_obj, *_ in traversal:
+            if total_score is None:
+                total_score = record.score
+            result.append(
+                {
+                    "label": record.label,
+                    "parent": record.parent,
+                    "score": record.score,
+                    "fraction": record.score / total_score,
+                    "amount": record.amount,
+                    "name": activity_obj.get("name", "(Unknown name)"),
+                    "key": activity_obj.key,
+                }
             )
 
-    if as_dataframe and __label == root_label:
-        return pd.DataFrame(__result_list)
+    if 0 in aborted:
+        return None
+    elif as_columns:
+        return result
+    elif as_dataframe:
+        return result.to_dataframe()
     else:
-        return __result_list
+        return result
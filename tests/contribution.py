@@ -1,7 +1,7 @@
 from .fixtures import lci_fixture, method_fixture
 from bw2analyzer.contribution import ContributionAnalysis as CA
 from bw2calc import LCA
-from bw2data import Method, Database
+from bw2data import Method, Database, get_activity
 from bw2data.tests import BW2DataTest
 from scipy import sparse
 import numpy as np
@@ -51,6 +51,26 @@ class ContributionTestCase(unittest.TestCase):
             )
         )
 
+    def test_sort_array_ties(self):
+        test_data = np.array((2.0, -3.0, 3.0, 1.0, 3.0, 2.0))
+        ca = CA()
+        self.assertEqual(
+            ca.sort_array(test_data, limit=4).tolist(),
+            [[3, 4], [3, 2], [-3, 1], [2, 5]],
+        )
+        self.assertEqual(
+            ca.sort_array(test_data, limit=0.2, limit_type="percent").tolist(),
+            [[3, 4], [3, 2], [-3, 1]],
+        )
+
+    def test_sort_array_limit_larger_than_data(self):
+        test_data = np.array((1.0, 2.0, 4.0, 3.0))
+        ca = CA()
+        self.assertEqual(
+            ca.sort_array(test_data, limit=10)[:, 1].tolist(), [2, 3, 1, 0]
+        )
+        self.assertEqual(ca.sort_array(test_data, limit=0).shape, (0, 2))
+
     def test_sort_array_errors(self):
         ca = CA()
         with self.assertRaises(ValueError):
@@ -82,6 +102,21 @@ class ContributionTestCase(unittest.TestCase):
         self.assertTrue(np.allclose((1, 2), columns))
         self.assertEqual([(3, 1, 0, 0, 7), (1, 2, 1, 1, 4)], elements)
 
+    def test_top_matrix_sparse_random(self):
+        matrix = sparse.random(60, 40, density=0.1, random_state=1, format="csc")
+        matrix.data -= 0.5
+        ca = CA()
+        elements, rows, columns = ca.top_matrix(matrix, 10, 8)
+        expected = [
+            (x, y, row, col, float(matrix[x, y]))
+            for row, x in enumerate(rows)
+            for col, y in enumerate(columns)
+            if matrix[x, y] != 0
+        ]
+        self.assertTrue(expected)
+        self.assertEqual(expected, elements)
+        self.assertEqual(expected, ca.top_matrix(matrix.toarray(), 10, 8)[0])
+
 
 class Contribution2TestCase(BW2DataTest):
     def install_fixtures(self):
@@ -113,3 +148,91 @@ class Contribution2TestCase(BW2DataTest):
             lca.dicts.biosphere.reversed,
             lca.dicts.activity.reversed,
         )
+
+    def test_d3_treemap_children(self):
+        self.install_fixtures()
+        lca = LCA({("a", "2"): 1}, ("method",))
+        lca.lci()
+        lca.lcia()
+        matrix = lca.characterized_inventory
+        data = CA().d3_treemap(
+            matrix,
+            lca.dicts.biosphere.reversed,
+            lca.dicts.activity.reversed,
+            limit=0.01,
+        )
+        self.assertAlmostEqual(data["size"], np.abs(matrix.toarray()).sum())
+        self.assertTrue(data["children"])
+        dense = np.abs(matrix.toarray())
+        for process in data["children"]:
+            self.assertIn("children", process)
+            sizes = sorted(
+                x["size"] for x in process["children"] if x["name"] != "Others"
+            )
+            column = [
+                column
+                for column in dense.T
+                if np.isclose(column.sum(), process["size"])
+            ][0]
+            self.assertEqual(
+                sizes,
+                sorted(x for x in column if x >= 0.01 * data["size"]),
+            )
+
+    def test_annotated_top_processes_names(self):
+        self.install_fixtures()
+        lca = LCA({("a", "2"): 1}, ("method",))
+        lca.lci()
+        lca.lcia()
+        ca = CA()
+        annotated = ca.annotated_top_processes(lca)
+        keys = ca.annotated_top_processes(lca, names=False)
+        self.assertEqual(
+            [x[2] for x in annotated], [get_activity(x[2]) for x in keys]
+        )
+        self.assertEqual(
+            ca.get_names([x[2] for x in keys]), [ca.get_name(x[2]) for x in keys]
+        )
+        emissions = ca.annotated_top_emissions(lca)
+        keys = ca.annotated_top_emissions(lca, names=False)
+        self.assertEqual(
+            [x[2] for x in emissions], [get_activity(x[2]) for x in keys]
+        )
+
+    def test_annotated_top_batch(self):
+        self.install_fixtures()
+        other = Method(("other",))
+        other.register()
+        other.write([(("a", "flow"), 3), (("c", "flow"), 2)])
+        demands = [{("a", "2"): 1}, {get_activity(("a", "1")): 2.5}]
+        methods = [("method",), ("other",)]
+        ca = CA()
+        df = ca.annotated_top_batch(demands, methods, limit=2)
+        # Two processes and one biosphere flow
+        self.assertEqual(len(df), 2 * 2 * (2 + 1))
+        self.assertEqual(df.loc[0, "name"], get_activity(df.loc[0, "id"])["name"])
+
+        for index, demand in enumerate(demands):
+            for method in methods:
+                lca = LCA(
+                    {get_activity(key): amount for key, amount in demand.items()},
+                    method,
+                )
+                lca.lci()
+                lca.lcia()
+                for kind, expected in (
+                    ("process", ca.annotated_top_processes(lca, names=False, limit=2)),
+                    ("emission", ca.annotated_top_emissions(lca, names=False, limit=2)),
+                ):
+                    rows = df[
+                        (df["demand"] == index)
+                        & (df["method"] == method)
+                        & (df["kind"] == kind)
+                    ].sort_values("rank")
+                    self.assertTrue(
+                        np.allclose(rows["score"], [x[0] for x in expected])
+                    )
+                    self.assertTrue(
+                        np.allclose(rows["amount"], [x[1] for x in expected])
+                    )
+                    self.assertEqual(list(rows["id"]), [x[2] for x in expected])
@@ -1,10 +1,21 @@
 from bw2analyzer.tagged import (
+    ForegroundIndex,
+    TaggedGraphArrays,
+    TaggedResultCache,
+    multi_recurse_tagged_database,
+    recurse_tagged_database,
     traverse_tagged_databases,
+    traverse_tagged_databases_batch,
     multi_traverse_tagged_databases,
+    aggregate_tagged_graph,
     get_cum_impact,
     get_multi_cum_impact,
+    group_tagged_graph,
+    iterate_tagged_databases,
 )
+from bw2calc import LCA
 from bw2data import Database, Method, get_activity
+from bw2data.backends import Activity
 from bw2data.tests import bw2test
 import pytest
 
@@ -155,6 +166,233 @@ def test_traverse_tagged_databases_scores(tagged_fixture):
     }
 
 
+def test_traverse_tagged_databases_single_solve(tagged_fixture, monkeypatch):
+    lca = LCA({("foreground", "fu"): 1}, ("test method",))
+    lca.lci()
+    lca.lcia()
+    method_dict = {o[0]: o[1] for o in Method(("test method",)).load()}
+    expected = recurse_tagged_database(
+        ("foreground", "fu"), 1, method_dict, lca, "tag field", "B"
+    )
+
+    def no_redo(*args, **kwargs):
+        raise AssertionError("Should use unit scores")
+
+    monkeypatch.setattr(LCA, "redo_lcia", no_redo)
+    _, graph = traverse_tagged_databases(
+        {("foreground", "fu"): 1}, ("test method",), label="tag field", default_tag="B"
+    )
+    assert graph == [expected]
+
+
+def test_traverse_tagged_databases_cache(tagged_fixture):
+    Database("diamond").write(
+        {
+            ("diamond", "fu"): {
+                "tag field": "A",
+                "exchanges": [
+                    {"input": ("diamond", "left"), "amount": 2, "type": "technosphere"},
+                    {"input": ("diamond", "right"), "amount": 3, "type": "technosphere"},
+                ],
+            },
+            ("diamond", "left"): {
+                "exchanges": [
+                    {"input": ("diamond", "bottom"), "amount": 1, "type": "technosphere"},
+                ],
+            },
+            ("diamond", "right"): {
+                "tag field": "C",
+                "exchanges": [
+                    {"input": ("diamond", "bottom"), "amount": 2, "type": "technosphere"},
+                ],
+            },
+            ("diamond", "bottom"): {
+                "tag field": "D",
+                "exchanges": [
+                    {"input": ("background", "first"), "amount": 4, "type": "technosphere"},
+                    {"input": ("biosphere", "worse"), "amount": 5, "type": "biosphere"},
+                ],
+            },
+        }
+    )
+    fu = {("diamond", "fu"): 1}
+    expected_scores, expected_graph = traverse_tagged_databases(
+        fu, ("test method",), label="tag field", default_tag="B"
+    )
+    scores, graph = traverse_tagged_databases(
+        fu, ("test method",), label="tag field", default_tag="B", cache_size=10
+    )
+    assert scores == expected_scores == {"A": 0, "B": 0, "C": 0, "D": 8 * 23}
+    assert graph == expected_graph
+
+    lca = LCA(fu, ("test method",))
+    lca.lci()
+    lca.lcia()
+    method_dict = {o[0]: o[1] for o in Method(("test method",)).load()}
+    cache = TaggedResultCache(maxsize=10)
+    assert recurse_tagged_database(
+        ("diamond", "fu"), 1, method_dict, lca, "tag field", "B", cache=cache
+    ) == expected_graph[0]
+    assert cache.hits == 1 and len(cache) == 4
+
+
+def test_traverse_tagged_databases_cache_shared_roots(tagged_fixture, monkeypatch):
+    Database("shared").write(
+        {
+            ("shared", "left"): {
+                "tag field": "A",
+                "exchanges": [
+                    {"input": ("shared", "bottom"), "amount": 1, "type": "technosphere"},
+                ],
+            },
+            ("shared", "right"): {
+                "exchanges": [
+                    {"input": ("shared", "bottom"), "amount": 2, "type": "technosphere"},
+                ],
+            },
+            ("shared", "bottom"): {
+                "tag field": "D",
+                "exchanges": [
+                    {"input": ("biosphere", "worse"), "amount": 5, "type": "biosphere"},
+                ],
+            },
+        }
+    )
+    caches = []
+
+    class RecordingCache(TaggedResultCache):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            caches.append(self)
+
+    monkeypatch.setattr("bw2analyzer.tagged.TaggedResultCache", RecordingCache)
+    fu = {("shared", "left"): 1, ("shared", "right"): 1}
+    expected = traverse_tagged_databases(
+        fu, ("test method",), label="tag field", default_tag="B"
+    )
+    assert traverse_tagged_databases(
+        fu, ("test method",), label="tag field", default_tag="B", cache_size=10
+    ) == expected
+    assert len(caches) == 1
+    # ``bottom`` is calculated for ``left``, and reused for ``right``
+    assert caches[0].hits == 1 and len(caches[0]) == 3
+
+
+def test_traverse_tagged_databases_prefetch(tagged_fixture, monkeypatch):
+    fu = {("foreground", "fu"): 1}
+    kwargs = {
+        "label": "tag field",
+        "default_tag": "B",
+        "secondary_tags": [("secondary tag", "unknown")],
+    }
+    expected = traverse_tagged_databases(
+        fu, ("test method",), prefetch=False, **kwargs
+    )
+
+    def no_queries(*args, **kwargs):
+        raise AssertionError("Should use prefetched index")
+
+    for name in ("technosphere", "biosphere", "production", "rp_exchange"):
+        monkeypatch.setattr(Activity, name, no_queries)
+    assert traverse_tagged_databases(fu, ("test method",), **kwargs) == expected
+
+    index = ForegroundIndex(["foreground"])
+    # Foreground activities, and background and biosphere inputs
+    assert len(index) == 5 + 2 + 2
+    biosphere = index.exchanges(get_activity(("foreground", "i")), "biosphere")
+    assert [exc["amount"] for exc in biosphere] == [5, 6]
+
+
+def test_traverse_tagged_databases_root_outside_fg_databases(tagged_fixture):
+    Database("sub").write(
+        {
+            ("sub", "s"): {
+                "tag field": "S",
+                "exchanges": [
+                    {"input": ("biosphere", "bad"), "amount": 1.5, "type": "biosphere"},
+                ],
+            },
+        }
+    )
+    Database("fg").write(
+        {
+            ("fg", "r"): {
+                "tag field": "A",
+                "exchanges": [
+                    {"input": ("biosphere", "bad"), "amount": 1, "type": "biosphere"},
+                    {"input": ("sub", "s"), "amount": 2, "type": "technosphere"},
+                ],
+            },
+        }
+    )
+    fu = {("fg", "r"): 1}
+    kwargs = {"label": "tag field", "default_tag": "B", "fg_databases": ["sub"]}
+    expected = {"A": 2, "S": 6}
+    scores, graph = traverse_tagged_databases(
+        fu, ("test method",), prefetch=False, **kwargs
+    )
+    assert scores == expected
+    scores, _ = traverse_tagged_databases(fu, ("test method",), **kwargs)
+    assert scores == expected
+
+    totals = {}
+    records = traverse_tagged_databases(
+        fu, ("test method",), stream=True, totals=totals, **kwargs
+    )
+    list(records)
+    assert totals == expected
+    batch = traverse_tagged_databases_batch([fu], ("test method",), **kwargs)
+    assert batch.to_dict("records") == [expected]
+
+    # Activities outside a given index are queried from the database
+    lca = LCA(fu, ("test method",))
+    lca.lci()
+    lca.lcia()
+    method_dict = {o[0]: o[1] for o in Method(("test method",)).load()}
+    assert recurse_tagged_database(
+        ("fg", "r"), 1, method_dict, lca, "tag field", "B", fg_databases=["sub"],
+        index=ForegroundIndex(["sub"]),
+    ) == graph[0]
+
+
+@bw2test
+def test_foreground_index_get_field():
+    Database("props").write(
+        {
+            ("props", "listed"): {
+                "classifications": [("tag field", "P")],
+                "exchanges": [],
+            },
+            ("props", "produced"): {
+                "exchanges": [
+                    {
+                        "input": ("props", "produced"),
+                        "amount": 1,
+                        "type": "production",
+                        "properties": {"tag field": "Q"},
+                    }
+                ],
+            },
+        }
+    )
+    index = ForegroundIndex(["props"])
+    for code, tag in (("listed", "P"), ("produced", "Q")):
+        activity = index.get_activity(("props", code))
+        assert index.get_field(activity, "tag field") == activity.get("tag field") == tag
+        assert index.get_field(activity, "missing", "default") == "default"
+
+
+def test_tagged_result_cache_eviction():
+    cache = TaggedResultCache(maxsize=2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.get(1) == "a"
+    cache.put(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a" and cache.get(3) == "c"
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
 def test_traverse_tagged_databases_graph(tagged_fixture):
     _, graph = traverse_tagged_databases(
         {("foreground", "fu"): 1}, ("test method",), label="tag field", default_tag="B"
@@ -519,6 +757,30 @@ def test_multi_traverse_tagged_databases_scores(tagged_fixture):
     }
 
 
+def test_multi_traverse_tagged_databases_single_solve(tagged_fixture, monkeypatch):
+    Method(("other method",)).write(
+        [(("biosphere", "bad"), 1), (("biosphere", "worse"), 10)]
+    )
+    methods = [("test method",), ("other method",)]
+    lca = LCA({("foreground", "fu"): 1}, methods[0])
+    lca.lci()
+    lca.lcia()
+    method_dicts = [{o[0]: o[1] for o in Method(m).load()} for m in methods]
+    expected = multi_recurse_tagged_database(
+        ("foreground", "fu"), 1, methods, method_dicts, lca, "tag field", "B"
+    )
+
+    def no_redo(*args, **kwargs):
+        raise AssertionError("Should use unit scores")
+
+    monkeypatch.setattr(LCA, "redo_lcia", no_redo)
+    scores, graph = multi_traverse_tagged_databases(
+        {("foreground", "fu"): 1}, methods, label="tag field", default_tag="B"
+    )
+    assert graph == [expected]
+    assert scores["B"] == [192, 30 + 440]
+
+
 def test_multi_traverse_tagged_databases_graph(tagged_fixture):
     _, graph = multi_traverse_tagged_databases(
         {("foreground", "fu"): 1},
@@ -946,6 +1208,27 @@ def test_get_cum_impact(tagged_fixture):
     assert cum_graph == expected
 
 
+def test_get_cum_impact_inplace(tagged_fixture):
+    _, graph = traverse_tagged_databases(
+        {("foreground", "fu"): 1}, ("test method",), label="tag field", default_tag="B"
+    )
+    expected = get_cum_impact(graph)
+    assert "cum_impact" not in graph[0]
+
+    assert get_cum_impact(graph, inplace=True) is graph
+    assert graph == expected
+    assert graph[0]["cum_impact"] == 72 + 192 + 186 + 42
+
+
+def test_get_cum_impact_deep_graph():
+    graph = node = {"impact": 1, "biosphere": [{"impact": 2}], "technosphere": []}
+    for _ in range(2000):
+        child = {"impact": 1, "biosphere": [{"impact": 2}], "technosphere": []}
+        node["technosphere"].append(child)
+        node = child
+    assert get_cum_impact([graph])[0]["cum_impact"] == 2 + 3 * 2000
+
+
 def test_get_multi_cum_impact(tagged_fixture):
     _, graph = multi_traverse_tagged_databases(
         {("foreground", "fu"): 1},
@@ -1057,3 +1340,271 @@ def test_get_multi_cum_impact(tagged_fixture):
         }
     ]
     assert cum_graph == expected
+
+
+def test_traverse_tagged_databases_compact(tagged_fixture, monkeypatch):
+    kwargs = {
+        "label": "tag field",
+        "default_tag": "B",
+        "secondary_tags": [("secondary tag", "unknown")],
+    }
+    fu = {("foreground", "fu"): 1}
+    expected_scores, expected_graph = traverse_tagged_databases(
+        fu, ("test method",), **kwargs
+    )
+
+    def not_nested(*args, **kwargs):
+        raise AssertionError("Should not build the nested graph")
+
+    with monkeypatch.context() as m:
+        m.setattr("bw2analyzer.tagged.recurse_tagged_database", not_nested)
+        m.setattr(TaggedGraphArrays, "from_nested", not_nested)
+        scores, graph = traverse_tagged_databases(
+            fu, ("test method",), compact=True, **kwargs
+        )
+    assert isinstance(graph, TaggedGraphArrays)
+    assert scores == expected_scores
+    assert aggregate_tagged_graph(graph) == aggregate_tagged_graph(expected_graph)
+    assert graph.to_nested() == expected_graph
+
+    # 5 activities with 6 biosphere exchanges
+    assert len(graph) == 11
+    assert graph.parent[0] == -1
+    assert (graph.kind == TaggedGraphArrays.BIOSPHERE).sum() == 6
+    assert graph.secondary_tags.shape == (11, 1)
+    assert graph.tags[graph.tag[0]] == "functional unit"
+
+
+@pytest.fixture
+def cyclic_fixture(tagged_fixture):
+    Database("cycle").write(
+        {
+            ("cycle", "a"): {
+                "exchanges": [
+                    {"input": ("cycle", "b"), "amount": 0.5, "type": "technosphere"},
+                    {"input": ("biosphere", "bad"), "amount": 1, "type": "biosphere"},
+                ],
+            },
+            ("cycle", "b"): {
+                "exchanges": [
+                    {"input": ("cycle", "a"), "amount": 0.5, "type": "technosphere"},
+                ],
+            },
+        }
+    )
+
+
+def test_iterate_tagged_databases_cycle(cyclic_fixture):
+    records = []
+    with pytest.raises(ValueError):
+        for record in iterate_tagged_databases({("cycle", "a"): 1}, ("test method",)):
+            records.append(record)
+    # ``a``, its biosphere flow, and ``b``, which consumes ``a`` again
+    assert len(records) == 3
+
+
+def test_traverse_tagged_databases_compact_cycle(cyclic_fixture):
+    with pytest.raises(ValueError):
+        traverse_tagged_databases({("cycle", "a"): 1}, ("test method",), compact=True)
+    with pytest.raises(ValueError):
+        multi_traverse_tagged_databases(
+            {("cycle", "a"): 1}, [("test method",)], compact=True
+        )
+
+
+def test_multi_traverse_tagged_databases_compact(tagged_fixture, monkeypatch):
+    methods = [("test method",), ("test method",)]
+    fu = {("foreground", "fu"): 1}
+    expected_scores, expected_graph = multi_traverse_tagged_databases(
+        fu, methods, label="tag field", default_tag="B"
+    )
+
+    def not_nested(*args, **kwargs):
+        raise AssertionError("Should not build the nested graph")
+
+    monkeypatch.setattr("bw2analyzer.tagged.multi_recurse_tagged_database", not_nested)
+    scores, graph = multi_traverse_tagged_databases(
+        fu, methods, label="tag field", default_tag="B", compact=True
+    )
+    assert graph.impact.shape == (11, 2)
+    assert scores == expected_scores
+    assert graph.to_nested() == expected_graph
+
+
+def test_group_tagged_graph(tagged_fixture):
+    secondary_tags = [("secondary tag", "unknown")]
+    scores, graph = traverse_tagged_databases(
+        {("foreground", "fu"): 1},
+        ("test method",),
+        label="tag field",
+        default_tag="B",
+        secondary_tags=secondary_tags,
+    )
+
+    df = group_tagged_graph(graph)
+    assert df["impact"].to_dict() == scores
+
+    df = group_tagged_graph(
+        graph, by=["secondary tag"], secondary_tags=secondary_tags
+    )
+    assert df["impact"].to_dict() == {
+        "X": 10 + 18 + 32,
+        "Y": 42 + 54 + 144 + 132,
+        "unknown": 60,
+    }
+
+    table = group_tagged_graph(
+        graph, by=["tag"], columns="secondary tag", secondary_tags=secondary_tags
+    )
+    assert table.loc["A", "Y"] == 54
+    assert table.loc["A", "unknown"] == 0
+    assert table.loc["B", "unknown"] == 60
+    assert table.sum(axis=1).to_dict() == scores
+
+    array, labels = group_tagged_graph(
+        graph, by=["tag", "secondary tag"], secondary_tags=secondary_tags, as_array=True
+    )
+    assert array.shape == (len(labels[0]), len(labels[1]), 1)
+    assert array[labels[0].index("A"), labels[1].index("Y"), 0] == 54
+    assert array.sum() == sum(scores.values())
+
+    with pytest.raises(ValueError):
+        group_tagged_graph(graph, by=["secondary tag"])
+
+
+def test_group_tagged_graph_multiple_methods(tagged_fixture):
+    Method(("other method",)).write(
+        [(("biosphere", "bad"), 1), (("biosphere", "worse"), 10)]
+    )
+    methods = [("test method",), ("other method",)]
+    scores, graph = multi_traverse_tagged_databases(
+        {("foreground", "fu"): 1}, methods, label="tag field", default_tag="B"
+    )
+    df = group_tagged_graph(graph, methods=methods)
+    assert list(df.columns) == methods
+    assert {tag: list(row) for tag, row in df.iterrows()} == scores
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_traverse_tagged_databases_batch(tagged_fixture, workers):
+    functional_units = [
+        {("foreground", "fu"): 1},
+        {("foreground", "i"): 2},
+        {("foreground", "iv"): 1, ("foreground", "ii"): 1},
+    ]
+    table = traverse_tagged_databases_batch(
+        functional_units,
+        ("test method",),
+        label="tag field",
+        default_tag="B",
+        workers=workers,
+        names=["fu", "i", "iv + ii"],
+    )
+    assert list(table.index) == ["fu", "i", "iv + ii"]
+    for name, functional_unit in zip(table.index, functional_units):
+        scores, _ = traverse_tagged_databases(
+            functional_unit, ("test method",), label="tag field", default_tag="B"
+        )
+        assert table.loc[name].sum() == sum(scores.values())
+        for tag, score in scores.items():
+            assert table.loc[name, tag] == score
+    assert table.loc["i", "functional unit"] == 0
+
+
+def test_tagged_traversals_single_factorization(tagged_fixture, monkeypatch):
+    fu = {("foreground", "fu"): 1}
+    kwargs = {"label": "tag field", "default_tag": "B"}
+    expected, _ = traverse_tagged_databases(fu, ("test method",), **kwargs)
+    expected_multi, _ = multi_traverse_tagged_databases(
+        fu, [("test method",)], **kwargs
+    )
+
+    def no_solve(*args, **kwargs):
+        raise AssertionError("Only the unit scores should be solved")
+
+    for name in ("lci", "lcia", "lci_calculation", "redo_lcia"):
+        monkeypatch.setattr(LCA, name, no_solve)
+    assert traverse_tagged_databases(fu, ("test method",), **kwargs)[0] == expected
+    assert (
+        multi_traverse_tagged_databases(fu, [("test method",)], **kwargs)[0]
+        == expected_multi
+    )
+    assert list(iterate_tagged_databases(fu, ("test method",), **kwargs))
+    table = traverse_tagged_databases_batch([fu], ("test method",), **kwargs)
+    assert table.loc[0].to_dict() == expected
+
+
+def test_recurse_tagged_database_size_check(tagged_fixture, monkeypatch):
+    import bw2analyzer.tagged
+
+    calls = []
+
+    class LargeDatabase:
+        def __init__(self, name):
+            calls.append(name)
+
+        def __len__(self):
+            return 3000
+
+    monkeypatch.setattr(bw2analyzer.tagged, "Database", LargeDatabase)
+    lca = LCA({("foreground", "fu"): 1}, ("test method",))
+    lca.lci()
+    lca.lcia()
+    method_dict = {o[0]: o[1] for o in Method(("test method",)).load()}
+
+    with pytest.warns(UserWarning, match="traversal may be slow"):
+        graph = recurse_tagged_database(
+            ("foreground", "fu"),
+            1,
+            method_dict,
+            lca,
+            "tag field",
+            "B",
+            fg_databases=["foreground"],
+        )
+    assert calls == ["foreground"]
+    assert len(graph["technosphere"]) == 2
+
+    recurse_tagged_database(
+        ("foreground", "fu"), 1, method_dict, lca, "tag field", "B", warned=True
+    )
+    assert calls == ["foreground"]
+    assert len(ForegroundIndex(["foreground"], chunk_size=1)) == 9
+
+
+def test_iterate_tagged_databases(tagged_fixture):
+    kwargs = {
+        "label": "tag field",
+        "default_tag": "B",
+        "secondary_tags": [("secondary tag", "unknown")],
+    }
+    fu = {("foreground", "fu"): 1}
+    scores, graph = traverse_tagged_databases(
+        fu, ("test method",), compact=True, **kwargs
+    )
+
+    totals = {}
+    records = iterate_tagged_databases(fu, ("test method",), totals=totals, **kwargs)
+    first = next(records)
+    assert first.path == (get_activity(("foreground", "fu")).id,)
+    assert first.tag == "functional unit" and first.secondary_tags == ["X"]
+    assert totals == {"functional unit": 0}
+
+    records = [first] + list(records)
+    assert totals == scores
+    assert [record.activity_id for record in records] == graph.activity_id.tolist()
+    assert [record.impact for record in records] == graph.impact.tolist()
+    assert [len(record.path) for record in records[:4]] == [1, 2, 3, 3]
+    assert records[3].path[:2] == records[1].path
+
+    streamed_totals = {}
+    streamed = traverse_tagged_databases(
+        fu, ("test method",), stream=True, totals=streamed_totals, **kwargs
+    )
+    assert list(streamed) == records
+    assert streamed_totals == scores
+
+    with pytest.raises(ValueError):
+        traverse_tagged_databases(
+            fu, ("test method",), stream=True, compact=True, **kwargs
+        )
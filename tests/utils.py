@@ -1,12 +1,21 @@
+import copy
+import inspect
 import io
+import sys
+from concurrent.futures import Future
 
 import bw2calc as bc
 import bw2data as bd
+import numpy as np
 import pandas as pd
 import pytest
 from bw2data.tests import bw2test
 
+import bw2analyzer.utils
 from bw2analyzer.utils import (
+    contribution_for_all_datasets_many_methods,
+    contribution_for_all_datasets_one_method,
+    iterate_supply_chain,
     print_recursive_calculation,
     print_recursive_supply_chain,
     recursive_calculation_to_object,
@@ -755,3 +764,441 @@ def test_recursive_calculation_to_object_nonunitary_production_multiple_producti
     with pytest.warns(UserWarning, match="Hit multiple production exchanges"):
         result = recursive_calculation_to_object(("f", "1"), ("m",))
     assert result is None
+
+
+@pytest.fixture
+@bw2test
+def contribution_fixture():
+    bd.Database("c").write(
+        {("c", "flow"): {"type": "emission"}, ("c", "other"): {"type": "emission"}}
+    )
+    data = copy.deepcopy(recursive_fixture)
+    del data[("a", "flow")]
+    for ds in data.values():
+        for exc in ds["exchanges"]:
+            if exc["type"] == "biosphere":
+                exc["input"] = ("c", "flow")
+    data[("a", "3")]["exchanges"].append(
+        {"input": ("c", "other"), "type": "biosphere", "amount": 3}
+    )
+    bd.Database("a").write(data)
+    bd.Method(("method",)).write([(("c", "flow"), 1)])
+    bd.Method(("other",)).write([(("c", "flow"), 2), (("c", "other"), 5)])
+    bd.Method(("third",)).write([(("c", "other"), 1)])
+
+
+def _contribution_reference(database, method):
+    lca = bc.LCA({bd.Database(database).random(): 1}, method)
+    lca.lci()
+    lca.lcia()
+    expected = {}
+    for ds in bd.Database(database):
+        if ds.id not in lca.dicts.product:
+            continue
+        lca.redo_lcia({ds.id: 1})
+        col = lca.dicts.activity[ds.id]
+        for kind, data in (
+            ("activities", lca.characterized_inventory.sum(axis=0)),
+            ("flows", lca.characterized_inventory.sum(axis=1)),
+            ("all", lca.characterized_inventory.data),
+        ):
+            scores = np.abs(np.array(data).ravel())
+            expected[(kind, col)] = -np.sort(-scores / scores.sum())
+    return expected
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 256])
+def test_contribution_for_all_datasets_one_method(contribution_fixture, batch_size):
+    expected = _contribution_reference("a", ("method",))
+    results = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False, batch_size=batch_size
+    )
+    assert results["activities"].shape == (5, 5)
+    for (kind, col), values in expected.items():
+        if kind == "all":
+            given = results[kind][: len(values), col]
+        else:
+            given = -np.sort(-results[kind][:, col])[: len(values)]
+        assert np.allclose(given, values)
+        assert np.isclose(results[kind][:, col].sum(), 1)
+
+
+def test_contribution_for_all_datasets_one_method_workers(contribution_fixture):
+    expected = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False
+    )
+    results = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False, batch_size=2, workers=2
+    )
+    for kind in expected:
+        assert np.allclose(results[kind], expected[kind])
+
+
+def test_parallel_contribution_blocks_bounded(monkeypatch):
+    submitted = []
+
+    class SerialExecutor:
+        def __init__(self, **kwargs):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def submit(self, func, *args):
+            future = Future()
+            future.set_result(func(*args))
+            submitted.append(future)
+            return future
+
+    monkeypatch.setattr(bw2analyzer.utils, "ProcessPoolExecutor", SerialExecutor)
+    monkeypatch.setattr(bw2analyzer.utils, "_contribution_worker", list)
+
+    in_flight, blocks = [], []
+    for block in bw2analyzer.utils._parallel_contribution_blocks(
+        {}, [], list(range(20)), batch_size=2, workers=2
+    ):
+        in_flight.append(len(submitted) - len(blocks))
+        blocks.append(block)
+    assert sorted(blocks) == [[x, x + 1] for x in range(0, 20, 2)]
+    assert max(in_flight) <= 4
+
+
+def test_contribution_for_all_datasets_one_method_memmap(
+    contribution_fixture, tmp_path
+):
+    expected = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False
+    )
+    results = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False, output="memmap", directory=tmp_path
+    )
+    for kind in expected:
+        assert np.allclose(np.load(tmp_path / f"{kind}.npy"), expected[kind])
+        assert np.allclose(results[kind], expected[kind])
+
+
+def test_contribution_for_all_datasets_one_method_sparse(contribution_fixture):
+    expected = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False
+    )
+    results = contribution_for_all_datasets_one_method(
+        "a", ("method",), progress=False, output="sparse", top_k=2
+    )
+    for kind in expected:
+        given = results[kind].toarray()
+        assert given.shape == expected[kind].shape
+        assert ((given != 0).sum(axis=0) <= 2).all()
+        assert np.allclose(
+            -np.sort(-given, axis=0)[:2], -np.sort(-expected[kind], axis=0)[:2]
+        )
+
+
+def test_contribution_for_all_datasets_one_method_output_error(contribution_fixture):
+    with pytest.raises(ValueError):
+        contribution_for_all_datasets_one_method(
+            "a", ("method",), progress=False, output="foo"
+        )
+
+
+@pytest.mark.parametrize("output", ["dense", "memmap", "sparse"])
+def test_contribution_for_all_datasets_one_method_resume(
+    contribution_fixture, monkeypatch, tmp_path, output
+):
+    kwargs = {"progress": False, "output": output, "directory": tmp_path}
+    expected = contribution_for_all_datasets_one_method(
+        "a",
+        ("method",),
+        progress=False,
+        output="sparse" if output == "sparse" else "dense",
+    )
+
+    original = bw2analyzer.utils._contribution_blocks
+    calculated = []
+
+    def crashing_blocks(*args, **kwargs):
+        for count, (ids, blocks) in enumerate(original(*args, **kwargs)):
+            if count == 2:
+                raise KeyboardInterrupt
+            calculated.extend(ids)
+            yield ids, blocks
+
+    monkeypatch.setattr(bw2analyzer.utils, "_contribution_blocks", crashing_blocks)
+    with pytest.raises(KeyboardInterrupt):
+        contribution_for_all_datasets_one_method(
+            "a", ("method",), batch_size=1, checkpoint_every=1, **kwargs
+        )
+    assert len(calculated) == 2
+
+    def counting_blocks(lca, solver, characterization, activity_ids, batch_size=256):
+        assert not set(activity_ids).intersection(calculated)
+        yield from original(lca, solver, characterization, activity_ids, batch_size)
+
+    monkeypatch.setattr(bw2analyzer.utils, "_contribution_blocks", counting_blocks)
+    results = contribution_for_all_datasets_one_method(
+        "a", ("method",), batch_size=1, checkpoint_every=1, **kwargs
+    )
+    for kind in expected:
+        if output == "sparse":
+            assert np.allclose(results[kind].toarray(), expected[kind].toarray())
+        else:
+            assert np.allclose(results[kind], expected[kind])
+    assert not list(bd.projects.request_directory("contribution_checkpoints").iterdir())
+
+
+@pytest.mark.parametrize("output", ["dense", "sparse"])
+def test_contribution_for_all_datasets_many_methods(contribution_fixture, output):
+    methods = [("method",), ("other",), ("third",)]
+    results = contribution_for_all_datasets_many_methods(
+        "a", methods, progress=False, batch_size=2, output=output, top_k=100
+    )
+    assert list(results) == methods
+    for method in methods:
+        expected = contribution_for_all_datasets_one_method("a", method, progress=False)
+        for kind in expected:
+            given = results[method][kind]
+            if output == "sparse":
+                given = given.toarray()
+            assert given.shape == expected[kind].shape
+            assert np.allclose(given, expected[kind])
+
+
+@bw2test
+def test_recursive_calculation_to_object_unit_scores(monkeypatch):
+    bd.Database("c").write({("c", "flow"): {"type": "emission"}})
+    bd.Database("a").write(recursive_fixture)
+    bd.Method(("method",)).write(method_fixture)
+
+    expected = recursive_calculation_to_object(
+        ("a", "1"), ("method",), max_level=5, cutoff=0.001, use_unit_scores=False
+    )
+
+    def no_redo(*args, **kwargs):
+        raise AssertionError("Should use unit scores")
+
+    monkeypatch.setattr(bc.LCA, "redo_lcia", no_redo)
+    result = recursive_calculation_to_object(
+        ("a", "1"), ("method",), max_level=5, cutoff=0.001
+    )
+    assert len(result) == len(expected) == 7
+    for given, reference in zip(result, expected):
+        assert given["label"] == reference["label"]
+        assert given["key"] == reference["key"]
+        assert given["score"] == pytest.approx(reference["score"])
+        assert given["fraction"] == pytest.approx(reference["fraction"])
+
+
+@bw2test
+def test_print_recursive_calculation_matrix_traversal(monkeypatch):
+    bd.Database("c").write({("c", "flow"): {"type": "emission"}})
+    bd.Database("a").write(recursive_fixture)
+    bd.Method(("method",)).write(method_fixture)
+
+    expected = io.StringIO()
+    print_recursive_calculation(
+        ("a", "1"), ("method",), cutoff=0.00025, file_obj=expected
+    )
+
+    def no_exchanges(*args, **kwargs):
+        raise AssertionError("Should use technosphere matrix")
+
+    monkeypatch.setattr(bc.LCA, "redo_lcia", no_exchanges)
+    monkeypatch.setattr(bd.backends.Activity, "technosphere", no_exchanges)
+    given = io.StringIO()
+    print_recursive_calculation(
+        ("a", "1"),
+        ("method",),
+        cutoff=0.00025,
+        file_obj=given,
+        matrix_traversal=True,
+    )
+    assert given.getvalue() == expected.getvalue()
+
+
+def test_iterate_supply_chain(rcto_fixture):
+    records = list(iterate_supply_chain(("f", "1"), ("m",), amount=1, cutoff=0.1))
+    expected = recursive_calculation_to_object(("f", "1"), ("m",), amount=1, cutoff=0.1)
+    assert [(r.label, r.parent, r.score, r.amount) for r in records] == [
+        (e["label"], e["parent"], e["score"], e["amount"]) for e in expected
+    ]
+    assert [r.activity_id for r in records] == [
+        bd.get_activity(e["key"]).id for e in expected
+    ]
+    assert records[0].level == 0 and records[-1].level > 0
+
+
+def test_iterate_supply_chain_matrix_values_without_method(rcto_fixture):
+    records = list(iterate_supply_chain(("f", "1"), use_matrix_values=True))
+    assert records == list(iterate_supply_chain(("f", "1")))
+    assert records[0].score is None and len(records) > 1
+
+
+@bw2test
+def test_iterate_supply_chain_deep_chain():
+    length = 300
+    data = {("d", "b"): {"exchanges": [], "type": "emission"}}
+    for index in range(length):
+        exchanges = [{"input": ("d", str(index)), "amount": 1, "type": "production"}]
+        if index < length - 1:
+            exchanges.append(
+                {"input": ("d", str(index + 1)), "amount": 1, "type": "technosphere"}
+            )
+        else:
+            exchanges.append({"input": ("d", "b"), "amount": 1, "type": "biosphere"})
+        data[("d", str(index))] = {"exchanges": exchanges}
+    bd.Database("d").write(data)
+    bd.Method(("m",)).write([(("d", "b"), 1)])
+
+    # Lower the recursion limit below the chain length instead of writing a
+    # chain longer than the default limit
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(len(inspect.stack(0)) + 150)
+    try:
+        records = list(
+            iterate_supply_chain(("d", "0"), ("m",), max_level=length, cutoff=0.5)
+        )
+    finally:
+        sys.setrecursionlimit(limit)
+    assert len(records) == length
+    assert records[-1].level == length - 1
+    assert all(record.score == pytest.approx(1) for record in records)
+
+    generator = iterate_supply_chain(("d", "0"), amount=2, max_level=length)
+    first, second = next(generator), next(generator)
+    generator.close()
+    assert first.score is None and second.amount == 2
+    assert second.parent == first.label == "root"
+
+
+def test_recursive_calculation_to_object_as_columns(rcto_fixture):
+    expected = recursive_calculation_to_object(("f", "1"), ("m",), max_level=10)
+    result = recursive_calculation_to_object(
+        ("f", "1"), ("m",), max_level=10, as_columns=True
+    )
+    assert len(result) == len(expected)
+    assert result.labels == [obj["label"] for obj in expected]
+    assert result.parent_labels == [obj["parent"] for obj in expected]
+    assert result.names == [obj["name"] for obj in expected]
+    assert result.keys == [obj["key"] for obj in expected]
+    assert np.allclose(result.score, [obj["score"] for obj in expected])
+    assert np.allclose(result.fraction, [obj["fraction"] for obj in expected])
+    assert result.parent[0] == -1 and result.level.max() > 1
+
+    df = recursive_calculation_to_object(
+        ("f", "1"), ("m",), max_level=10, as_dataframe=True
+    )
+    assert df.equals(pd.DataFrame(expected))
+
+
+def test_supply_chain_columns_growth():
+    result = bw2analyzer.utils.SupplyChainColumns(root_label="x", capacity=1)
+    result.append(-1, 0, 0, 4, 1, 1)
+    for index in range(30):
+        result.append(index, 27, index + 1, 2, 1, 1)
+    assert len(result) == 31
+    assert np.allclose(result.fraction[1:], 0.5)
+    assert result.labels[:3] == ["x", "x_ab", "x_ab_ab"]
+
+
+def test_supply_chain_columns_parquet(rcto_fixture, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    result = recursive_calculation_to_object(
+        ("f", "1"), ("m",), max_level=10, as_columns=True
+    )
+    result.to_parquet(tmp_path / "result.parquet")
+    table = pq.read_table(tmp_path / "result.parquet")
+    assert table.column("label").to_pylist() == result.labels
+    assert table.column("activity_id").to_pylist() == result.activity_id.tolist()
+    assert table.column("database").to_pylist() == [key[0] for key in result.keys]
+
+
+@bw2test
+def test_print_recursive_supply_chain_matrix_traversal(monkeypatch):
+    bd.Database("a").write(recursive_fixture)
+    bd.Database("f").write(
+        {
+            ("f", "1"): {
+                "location": "GLO",
+                "exchanges": [
+                    {"input": ("f", "1"), "amount": 3, "type": "production"},
+                    {"input": ("f", "1"), "amount": 1, "type": "technosphere"},
+                    {"input": ("f", "2"), "amount": 2, "type": "technosphere"},
+                ],
+            },
+            ("f", "2"): {"location": "GLO", "exchanges": []},
+        }
+    )
+    kwargs = [
+        {"activity": ("a", "1"), "cutoff": 0, "max_level": 5},
+        {"activity": ("a", "1"), "cutoff": 0.05, "max_level": 5, "amount": 2},
+        {"activity": ("f", "1")},
+    ]
+    expected = []
+    for kwarg in kwargs:
+        expected.append(io.StringIO())
+        print_recursive_supply_chain(file_obj=expected[-1], **kwarg)
+
+    def no_exchanges(*args, **kwargs):
+        raise AssertionError("Should use technosphere matrix")
+
+    monkeypatch.setattr(bd.backends.Activity, "technosphere", no_exchanges)
+    for kwarg, output in zip(kwargs, expected):
+        given = io.StringIO()
+        print_recursive_supply_chain(file_obj=given, matrix_traversal=True, **kwarg)
+        assert given.getvalue() == output.getvalue()
+
+    lca = bc.LCA({("a", "1"): 1})
+    lca.load_lci_data()
+    given = io.StringIO()
+    print_recursive_supply_chain(
+        file_obj=given, matrix_traversal=True, lca=lca, **kwargs[0]
+    )
+    assert given.getvalue() == expected[0].getvalue()
+
+
+@bw2test
+def test_resolve_activities_cache(monkeypatch):
+    bd.Database("a").write(recursive_fixture)
+    ids = [bd.get_activity(("a", str(index))).id for index in range(1, 4)]
+    bw2analyzer.utils.activity_cache.clear()
+
+    queried = []
+    activities_by_id = bw2analyzer.utils._activities_by_id
+
+    def counting(ids, *args, **kwargs):
+        queried.append(sorted(ids))
+        return activities_by_id(ids, *args, **kwargs)
+
+    monkeypatch.setattr(bw2analyzer.utils, "_activities_by_id", counting)
+    activities = bw2analyzer.utils.resolve_activities(ids[:2])
+    assert activities[ids[0]]["name"] == "process 1"
+    activities = bw2analyzer.utils.resolve_activities(ids)
+    assert sorted(activities) == sorted(ids)
+    assert queried == [sorted(ids[:2]), [ids[2]]]
+
+    activity = bd.get_activity(("a", "1"))
+    activity["name"] = "changed"
+    activity.save()
+    activities = bw2analyzer.utils.resolve_activities(ids)
+    assert activities[ids[0]]["name"] == "changed"
+    assert queried[-1] == sorted(ids)
+
+    bw2analyzer.utils.resolve_activities(ids, use_cache=False)
+    assert len(queried) == 4
+
+
+@bw2test
+def test_activity_cache_eviction():
+    class Fake(dict):
+        def __init__(self, id_):
+            super().__init__(database="none")
+            self.id = id_
+
+    cache = bw2analyzer.utils.ActivityCache(maxsize=2)
+    for index in range(3):
+        cache.put(Fake(index))
+    assert len(cache) == 2
+    assert cache.get(0) is None and cache.get(2) is not None